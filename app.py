@@ -1,19 +1,54 @@
 import os
+import threading
 import controller.video
 import controller.ai_test
+import controller.jobs
+import controller.live
+import controller.metrics
 # import speech_recognition as sr
 
-import nltk
-
 from controller.core import app
+from werkzeug.serving import is_running_from_reloader
 
-nltk.download('punkt')
+from whisper_models import whisper_models
 
 app.config['UPLOAD_FOLDER'] = ('uploads')
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+# Maximum number of pipeline stages of a single /process_video request that run at the same time,
+# 0 runs all of them at once
+app.config['PIPELINE_MAX_WORKERS'] = int(os.environ.get('PIPELINE_MAX_WORKERS', 0))
+
+_start_lock = threading.Lock()
+_started = False
+
+
+# Work of a server process that must not happen on import: worker processes spawned by the
+# emotions and transcription pools import this module again, and so does the reloader's
+# file watcher. Runs once per process.
+def start_server():
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+
+        # Load the configured Whisper models at startup instead of on the first transcription
+        if os.environ.get('WHISPER_PRELOAD', '0') == '1':
+            whisper_models.preload()
+        controller.jobs.job_queue.start()
+
+
+# Servers that import the application instead of running app.py start with their first request
+@app.before_request
+def start_server_on_first_request():
+    start_server()
 
 
 def main():
+    # With the debug reloader main() also runs in the process that watches the files, only
+    # the server process it starts loads models and runs jobs
+    if is_running_from_reloader():
+        start_server()
     app.run(debug=True)
 
 
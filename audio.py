@@ -1,14 +1,38 @@
-import whisper
-from moviepy.video.io.VideoFileClip import VideoFileClip
+import os
+import subprocess
+import wave
 
+import numpy as np
 
-def transcribe(audio_path):
+import fake_backends
+from process_pools import SpawnedPool
+from whisper_models import whisper_models, DEFAULT_MODEL
+
+# Whisper works on 16 kHz mono audio
+SAMPLE_RATE = 16000
+PERSIST_AUDIO = os.environ.get('PERSIST_AUDIO', '0') == '1'
+# Processes transcribing chunks of long audio in parallel, 0 transcribes it in one piece
+TRANSCRIBE_WORKERS = int(os.environ.get('TRANSCRIBE_WORKERS', 0))
+# Approximate length of the chunks, they're cut at the quietest moment near these points
+TRANSCRIBE_CHUNK_SECONDS = float(os.environ.get('TRANSCRIBE_CHUNK_SECONDS', 120))
+# Audio added on both sides of a chunk so words at a cut are heard in full
+CHUNK_PADDING_SECONDS = 1.0
+
+
+# Failures are reported as a placeholder transcription without segments, or raised with
+# raise_errors. lane selects a copy of the model of whisper_models, used without workers.
+def transcribe(audio, model_name=DEFAULT_MODEL, workers=TRANSCRIBE_WORKERS, chunk_seconds=TRANSCRIBE_CHUNK_SECONDS,
+               raise_errors=False, lane="default"):
     try:
-        # Load the Whisper model
-        model = whisper.load_model("base")
+        if workers > 0:
+            if isinstance(audio, str):
+                audio = load_audio(audio)
+            if len(audio) > 1.5 * chunk_seconds * SAMPLE_RATE:
+                return transcribe_in_chunks(audio, model_name, workers, chunk_seconds)
 
-        # Transcribe the audio
-        result = model.transcribe(audio_path, word_timestamps= True)
+        # Transcribe the audio (a file path or a 16 kHz float32 buffer) with the shared Whisper model
+        with whisper_models.acquire(model_name, lane) as model:
+            result = model.transcribe(audio, word_timestamps= True)
 
         segments = [
             {"text": seg["text"].strip(), "from": seg["start"], "to": seg["end"]}
@@ -17,12 +41,131 @@ def transcribe(audio_path):
         return result["text"], segments
 
     except Exception as e:
+        if raise_errors:
+            raise
         print(f"An error occurred during transcription: {e}")
         transcription = "An error occurred during transcription."
 
     return transcription, []
 
 
-def extract_audio_file(audio_path, video_path):
-    video_clip = VideoFileClip(video_path)
-    video_clip.audio.write_audiofile(audio_path)
+# Sample indexes where long audio is cut into chunks of about chunk_seconds, including 0 and
+# len(audio). Each cut is placed in the quietest silence_seconds (lowest mean energy of
+# 30 ms frames) within a quarter of a chunk of the regular cut point, so cuts fall between
+# words whenever the speaker pauses.
+def split_at_silences(audio, chunk_seconds, sample_rate=SAMPLE_RATE, frame_seconds=0.03, silence_seconds=0.5):
+    frame = int(frame_seconds * sample_rate)
+    frames = len(audio) // frame
+    step = int(chunk_seconds / frame_seconds)
+    if frames <= step:
+        return [0, len(audio)]
+
+    energy = np.square(audio[:frames * frame].reshape(frames, frame)).mean(axis=1)
+    width = max(int(silence_seconds / frame_seconds), 1)
+    smoothed = np.convolve(energy, np.ones(width) / width, mode="same")
+
+    search = step // 4
+    cuts = [0]
+    target = step
+    # The last chunk is at least half a chunk long
+    while target < frames - step // 2:
+        low = max(target - search, cuts[-1] + 1)
+        high = min(target + search, frames - 1)
+        # Of equally quiet moments the one closest to the regular cut point wins
+        distance = np.abs(np.arange(low, high + 1) - target) / search
+        cuts.append(low + int(np.argmin(smoothed[low:high + 1] * (1 + distance))))
+        target = cuts[-1] + step
+
+    return [cut * frame for cut in cuts] + [len(audio)]
+
+
+_pool = SpawnedPool()
+
+
+def _load_worker_model(model_name, threads):
+    if not fake_backends.enabled("whisper"):
+        import torch
+
+        # Workers share the cores instead of each starting a thread per core
+        torch.set_num_threads(threads)
+    whisper_models.get(model_name)
+
+
+# Transcribes one chunk in a worker. Returns its words with timestamps in the whole audio,
+# grouped by Whisper segment.
+def _transcribe_chunk(chunk, offset, model_name):
+    with whisper_models.acquire(model_name) as model:
+        result = model.transcribe(chunk, word_timestamps=True)
+
+    segments = []
+    for segment in result["segments"]:
+        # Word timestamps can be missing, the whole segment then counts as one word
+        words = segment.get("words") or [{"word": segment["text"], "start": segment["start"], "end": segment["end"]}]
+        segments.append([{"word": word["word"], "start": word["start"] + offset, "end": word["end"] + offset}
+                         for word in words])
+    return segments
+
+
+# Splits the audio at silences and transcribes the chunks in parallel processes. Chunks are
+# padded, and a word is kept only by the chunk it was heard in the middle of, so words at
+# the cuts are neither lost nor repeated.
+def transcribe_in_chunks(audio, model_name=DEFAULT_MODEL, workers=TRANSCRIBE_WORKERS,
+                         chunk_seconds=TRANSCRIBE_CHUNK_SECONDS):
+    cuts = split_at_silences(audio, chunk_seconds)
+    padding = int(CHUNK_PADDING_SECONDS * SAMPLE_RATE)
+
+    calls = []
+    for start, end in zip(cuts, cuts[1:]):
+        chunk_start = max(start - padding, 0)
+        calls.append((_transcribe_chunk, audio[chunk_start:min(end + padding, len(audio))],
+                      chunk_start / SAMPLE_RATE, model_name))
+    # Each worker loads the model once, the workers share the cores
+    chunk_words = _pool.run(calls, workers, _load_worker_model,
+                            (model_name, max((os.cpu_count() or 1) // workers, 1)))
+
+    segments = []
+    for start, end, words_by_segment in zip(cuts, cuts[1:], chunk_words):
+        for words in words_by_segment:
+            owned = [word for word in words if start / SAMPLE_RATE <= (word["start"] + word["end"]) / 2 < end / SAMPLE_RATE]
+            text = "".join(word["word"] for word in owned).strip()
+            if text:
+                segments.append({"text": text, "from": owned[0]["start"], "to": owned[-1]["end"]})
+
+    return " ".join(segment["text"] for segment in segments), segments
+
+
+# Decodes the audio track of a video to a mono float32 buffer, streamed from an ffmpeg pipe
+def load_audio(video_path, sample_rate=SAMPLE_RATE):
+    command = [
+        "ffmpeg", "-nostdin", "-threads", "0", "-i", video_path,
+        "-vn", "-f", "f32le", "-acodec", "pcm_f32le", "-ac", "1", "-ar", str(sample_rate), "-"
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    buffer = bytearray()
+    while True:
+        chunk = process.stdout.read(1024 * 1024)
+        if not chunk:
+            break
+        buffer.extend(chunk)
+    process.stdout.close()
+
+    if process.wait() != 0:
+        raise RuntimeError(f"ffmpeg failed to decode audio of {video_path}")
+
+    return np.frombuffer(buffer, dtype=np.float32)
+
+
+def save_audio(audio, audio_path, sample_rate=SAMPLE_RATE):
+    with wave.open(audio_path, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes((np.clip(audio, -1, 1) * 32767).astype(np.int16).tobytes())
+
+
+# Returns the decoded audio of the video and writes it to audio_path only when one is given
+def extract_audio(video_path, audio_path=None):
+    audio = load_audio(video_path)
+    if audio_path is not None:
+        save_audio(audio, audio_path)
+    return audio
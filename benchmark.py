@@ -0,0 +1,268 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+REPOSITORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentiles(values):
+    if not values:
+        return None
+    return {
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "mean": float(np.mean(values)),
+        "max": float(np.max(values)),
+    }
+
+
+class PeakMemory:
+    # Samples the resident memory of this process and of its child processes (Whisper and
+    # emotion workers) in the background while the block runs
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    @staticmethod
+    def _descendants(pid):
+        children = {}
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as file:
+                    # The parent comes after the command name, which can hold spaces
+                    parent = int(file.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(parent, []).append(int(entry))
+
+        found = []
+        pending = [pid]
+        while pending:
+            for child in children.get(pending.pop(), []):
+                found.append(child)
+                pending.append(child)
+        return found
+
+    @classmethod
+    def rss_bytes(cls):
+        if not os.path.exists("/proc/self/statm"):
+            # Peaks of the whole lifetime, in kilobytes on Linux and bytes on macOS. Children
+            # only count once they have exited.
+            usage = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                     + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+            return usage * (1 if sys.platform == "darwin" else 1024)
+
+        total = 0
+        for pid in [os.getpid()] + cls._descendants(os.getpid()):
+            try:
+                with open(f"/proc/{pid}/statm") as file:
+                    total += int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+            except (OSError, IndexError, ValueError):
+                # The process exited between listing and reading
+                continue
+        return total
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.rss_bytes())
+
+    def __enter__(self):
+        self.peak = self.rss_bytes()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.rss_bytes())
+
+
+# Uploads every video to POST /process_video, `concurrency` at a time, and collects the
+# latency and the per-request timings of each upload
+def run_scenario(app, videos, concurrency):
+    from cache import embedding_cache
+    from results import result_store
+
+    # Every scenario starts cold, otherwise the embeddings and results of the previous one
+    # make it look faster than it is. The LLM response cache is off for the whole run.
+    embedding_cache.clear()
+    result_store.memory.clear()
+    shutil.rmtree(result_store.folder, ignore_errors=True)
+
+    def upload(path):
+        started = time.perf_counter()
+        with open(path, "rb") as file:
+            response = app.test_client().post(
+                "/process_video?no_cache=1&timings=1",
+                data={"video_file": (file, os.path.basename(path))},
+                content_type="multipart/form-data"
+            )
+        seconds = time.perf_counter() - started
+        body = response.get_json(silent=True) or {}
+        return response.status_code, seconds, body.get("timings")
+
+    with PeakMemory() as memory:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            responses = list(executor.map(upload, videos))
+        wall_seconds = time.perf_counter() - started
+
+    from fake_backends import profile
+
+    latencies = [seconds for status, seconds, _ in responses if status == 200]
+    stage_seconds = {}
+    stage_queue_seconds = {}
+    models = {}
+    for _, _, timings in responses:
+        for name, stage in (timings or {}).get("stages", {}).items():
+            stage_seconds.setdefault(name, []).append(stage["seconds"])
+            stage_queue_seconds.setdefault(name, []).append(stage["queue_seconds"])
+        for name, usage in (timings or {}).get("models", {}).items():
+            totals = models.setdefault(name, {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                                              "wait_seconds": 0.0, "errors": 0})
+            for key in totals:
+                totals[key] += usage[key]
+
+    for name, totals in models.items():
+        prices = profile(name)
+        totals["cost_usd"] = (totals["prompt_tokens"] * prices.get("prompt_price", 0)
+                              + totals["completion_tokens"] * prices.get("completion_price", 0)) / 1e6
+
+    return {
+        "uploads": len(videos),
+        "errors": len(videos) - len(latencies),
+        "wall_seconds": wall_seconds,
+        "throughput_per_minute": len(latencies) / wall_seconds * 60,
+        "latency_seconds": percentiles(latencies),
+        "stages": {name: {"seconds": percentiles(values), "queue_seconds": percentiles(stage_queue_seconds[name])}
+                   for name, values in sorted(stage_seconds.items())},
+        "models": models,
+        "peak_rss_mb": memory.peak / 2 ** 20,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPOSITORY, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Prints the change of every scenario against a stored baseline. Returns the metrics that
+# got worse by more than `tolerance` (1.2 allows 20%).
+def compare(baseline, report, tolerance):
+    previous = {(scenario["duration"], scenario["concurrency"]): scenario for scenario in baseline["scenarios"]}
+    metrics = [
+        ("latency p50", lambda scenario: (scenario["latency_seconds"] or {}).get("p50"), False),
+        ("latency p95", lambda scenario: (scenario["latency_seconds"] or {}).get("p95"), False),
+        ("throughput/min", lambda scenario: scenario["throughput_per_minute"], True),
+        ("peak rss mb", lambda scenario: scenario["peak_rss_mb"], False),
+    ]
+
+    regressions = []
+    print(f"\nCompared with {baseline.get('commit') or 'baseline'} from {baseline.get('created_at')}")
+    print(f"{'duration':>9} {'at once':>8}  {'metric':<15} {'baseline':>10} {'current':>10} {'change':>8}")
+    for scenario in report["scenarios"]:
+        old = previous.get((scenario["duration"], scenario["concurrency"]))
+        if old is None:
+            continue
+        for name, value, higher_is_better in metrics:
+            before, after = value(old), value(scenario)
+            if not before or after is None:
+                continue
+            ratio = after / before
+            worse = ratio < 1 / tolerance if higher_is_better else ratio > tolerance
+            print(f"{scenario['duration']:>8g}s {scenario['concurrency']:>8}  {name:<15} {before:>10.2f} "
+                  f"{after:>10.2f} {ratio - 1:>+8.0%}{'  worse' if worse else ''}")
+            if worse:
+                regressions.append((scenario["duration"], scenario["concurrency"], name))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark /process_video offline, with the fake models of fake_backends")
+    parser.add_argument("--durations", default="30,120,600", help="comma separated lengths of the videos, in seconds")
+    parser.add_argument("--concurrency", default="1,4", help="comma separated numbers of concurrent uploads")
+    parser.add_argument("--uploads", type=int, default=4, help="videos uploaded in every scenario")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="multiplies every fake latency")
+    parser.add_argument("--profiles", help="JSON file with latency and price profiles merged over the defaults")
+    parser.add_argument("--real-whisper", action="store_true", help="transcribe with Whisper instead of a fake")
+    parser.add_argument("--output", help="write the report to this JSON file")
+    parser.add_argument("--compare", help="JSON report of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.2, help="ratio above which a metric counts as worse")
+    args = parser.parse_args()
+
+    durations = [float(duration) for duration in args.durations.split(",")]
+    concurrencies = [int(concurrency) for concurrency in args.concurrency.split(",")]
+
+    # The application reads its configuration on import, so the fakes are set up first. It
+    # runs in a scratch folder, caches and uploads of earlier runs don't change the numbers.
+    os.environ["FAKE_BACKENDS"] = "llm,video" if args.real_whisper else "llm,video,whisper"
+    os.environ["FAKE_LATENCY_SCALE"] = str(args.latency_scale)
+    os.environ["LLM_CACHE"] = "off"
+    os.environ.setdefault("NLTK_DATA", os.path.join(REPOSITORY, "nltk_data"))
+    if args.profiles:
+        with open(args.profiles) as file:
+            os.environ["FAKE_BACKEND_PROFILES"] = file.read()
+    output = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+
+    workdir = tempfile.mkdtemp(prefix="benchmark-")
+    os.chdir(workdir)
+    sys.path.insert(0, REPOSITORY)
+
+    import app
+    from fake_backends import FAKE_BACKEND_PROFILES, create_video
+
+    os.makedirs("videos")
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "settings": {**vars(args), "profiles": FAKE_BACKEND_PROFILES, "fake_backends": os.environ["FAKE_BACKENDS"]},
+        "scenarios": [],
+    }
+    for duration in durations:
+        videos = [create_video(os.path.join("videos", f"{duration:g}s-{seed}.mp4"), duration, seed)
+                  for seed in range(args.uploads)]
+        for concurrency in concurrencies:
+            print(f"{duration:g} s videos, {concurrency} at a time...", file=sys.stderr)
+            scenario = run_scenario(app.app, videos, concurrency)
+            report["scenarios"].append({"duration": duration, "concurrency": concurrency, **scenario})
+
+    os.chdir(REPOSITORY)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    if output:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if baseline_path:
+        with open(baseline_path) as file:
+            regressions = compare(json.load(file), report, args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+import contextvars
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class LRUCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def normalize_text(text):
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def text_hash(text):
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    # Embedding vectors keyed by (model name, hash of the normalized text). Lookups go to
+    # an in-memory LRU first and to a SQLite file second. Vectors are float32 arrays in
+    # memory (a list of Python floats takes eight times as much) and float32 blobs on disk.
+    # When the file holds more than max_entries rows the least recently used go.
+    def __init__(self, path, max_entries=100000, memory_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self.memory = LRUCache(memory_entries)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # The file is opened on first use, importing the application doesn't touch the disk
+        self._connect_lock = threading.Lock()
+        self._db = None
+
+    @property
+    def _connection(self):
+        with self._connect_lock:
+            if self._db is None:
+                self._db = self._connect()
+            return self._db
+
+    def _connect(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )
+        """)
+        connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        connection.commit()
+        # Kept up to date by put_many, counting the rows on every write scans the whole table
+        self._count = connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return connection
+
+    # Returns one float32 array or None per text
+    def get_many(self, model, texts):
+        keys = [text_hash(text) for text in texts]
+        vectors = [self.memory.get((model, key)) for key in keys]
+
+        missing = list({key for key, vector in zip(keys, vectors) if vector is None})
+        if missing:
+            stored = {}
+            with self._lock:
+                for start in range(0, len(missing), 500):
+                    chunk = missing[start:start + 500]
+                    rows = self._connection.execute(
+                        "SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({})".format(
+                            ",".join("?" * len(chunk))),
+                        [model] + chunk
+                    ).fetchall()
+                    stored.update({key: np.frombuffer(blob, dtype=np.float32) for key, blob in rows})
+                if stored:
+                    now = time.time()
+                    self._connection.executemany(
+                        "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                        [(now, model, key) for key in stored]
+                    )
+                    self._connection.commit()
+
+            for key, vector in stored.items():
+                self.memory.put((model, key), vector)
+            vectors = [stored.get(key) if vector is None else vector for key, vector in zip(keys, vectors)]
+
+        hits = sum(vector is not None for vector in vectors)
+        with self._lock:
+            self.hits += hits
+            self.misses += len(vectors) - hits
+        return vectors
+
+    def put_many(self, model, texts, vectors):
+        now = time.time()
+        rows = {}
+        for text, vector in zip(texts, vectors):
+            key = text_hash(text)
+            vector = np.asarray(vector, dtype=np.float32)
+            self.memory.put((model, key), vector)
+            rows[key] = (model, key, vector.tobytes(), now)
+
+        keys = list(rows)
+        with self._lock:
+            existing = 0
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                existing += self._connection.execute(
+                    "SELECT COUNT(*) FROM embeddings WHERE model = ? AND text_hash IN ({})".format(
+                        ",".join("?" * len(chunk))),
+                    [model] + chunk
+                ).fetchone()[0]
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector, last_used) VALUES (?, ?, ?, ?)",
+                list(rows.values()))
+            self._count += len(rows) - existing
+            if self._count > self.max_entries:
+                self._connection.execute(
+                    "DELETE FROM embeddings WHERE rowid IN "
+                    "(SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (self._count - self.max_entries,)
+                )
+                self._count = self.max_entries
+            self._connection.commit()
+
+    def clear(self):
+        self.memory.clear()
+        with self._lock:
+            self._connection.execute("DELETE FROM embeddings")
+            self._connection.commit()
+            self._count = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "memory_entries": len(self.memory)}
+
+
+embedding_cache = EmbeddingCache(
+    path=os.environ.get('EMBEDDING_CACHE_PATH', os.path.join('cache', 'embeddings.sqlite')),
+    max_entries=int(os.environ.get('EMBEDDING_CACHE_MAX_ENTRIES', 100000)),
+    memory_entries=int(os.environ.get('EMBEDDING_CACHE_MEMORY_ENTRIES', 10000))
+)
+
+
+_bypass_response_cache = contextvars.ContextVar("bypass_response_cache", default=False)
+
+
+# LLM calls made inside this block skip the response cache lookup. Fresh responses still
+# replace the cached ones.
+@contextmanager
+def bypass_response_cache(bypass=True):
+    token = _bypass_response_cache.set(bypass)
+    try:
+        yield
+    finally:
+        _bypass_response_cache.reset(token)
+
+
+def response_cache_bypassed():
+    return _bypass_response_cache.get()
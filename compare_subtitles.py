@@ -1,28 +1,126 @@
-from langchain_core.output_parsers import PydanticOutputParser
-from langchain_core.prompts import PromptTemplate
+import difflib
+import os
+import re
 
-from llm_models import open_ai_llm_mini
-from transcript_analysis_models import SubtitlesAnalysis
+from intervals import IntervalIndex
+from llm_models import checked_chain, open_ai_llm_mini
+from transcript_analysis_models import SubtitlesAnalysis, SubtitlesChanges
 
+# Aligned pairs less similar than this are explained by the LLM instead of a word diff
+SUBTITLES_LLM_THRESHOLD = float(os.environ.get('SUBTITLES_LLM_THRESHOLD', 0.6))
+# Words at least this similar are treated as the same word with a minor (e.g. single letter) change
+MINOR_CHANGE_RATIO = 0.8
 
-def compare_subtitles(transcription, ocr):
-    ocr_subtitles = " ".join(sentence["text"] for sentence in ocr)
 
-    parser = PydanticOutputParser(pydantic_object=SubtitlesAnalysis)
+def normalize(text):
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+
+def similarity(first, second):
+    return difflib.SequenceMatcher(None, first, second, autojunk=False).ratio()
+
+
+# Assigns every OCR subtitle to the transcript segment it overlaps most in time and returns
+# (segment text, text of its subtitles) pairs, followed by ("", subtitle text) for every
+# subtitle shown while nothing was said
+def align(segments, ocr):
+    index = IntervalIndex(ocr)
+    best = {}
+    for segment_index, segment in enumerate(segments):
+        for subtitle in index.overlapping(segment["from"], segment["to"]):
+            overlap = min(segment["to"], subtitle["end_time"]) - max(segment["from"], subtitle["start_time"])
+            if id(subtitle) not in best or overlap > best[id(subtitle)][0]:
+                best[id(subtitle)] = (overlap, segment_index)
+
+    assigned = [[] for _ in segments]
+    unaligned = []
+    for subtitle in index.items:
+        if id(subtitle) in best:
+            assigned[best[id(subtitle)][1]].append(subtitle["text"])
+        else:
+            unaligned.append(("", subtitle["text"]))
+
+    return [(segment["text"], " ".join(texts)) for segment, texts in zip(segments, assigned)] + unaligned
+
+
+def word_changes(transcription_text, ocr_text):
+    transcription_words = normalize(transcription_text).split()
+    ocr_words = normalize(ocr_text).split()
+
+    changes = []
+    matcher = difflib.SequenceMatcher(None, transcription_words, ocr_words, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        expected = " ".join(transcription_words[i1:i2])
+        found = " ".join(ocr_words[j1:j2])
+        if tag == "replace" and similarity(expected, found) < MINOR_CHANGE_RATIO:
+            changes.append(f"'{found}' instead of '{expected}'")
+        elif tag == "delete":
+            changes.append(f"'{expected}' missing in subtitles")
+        elif tag == "insert":
+            changes.append(f"'{found}' added in subtitles")
+    return changes
+
+
+def explain_changes(pairs):
+    from langchain_core.output_parsers import PydanticOutputParser
+    from langchain_core.prompts import PromptTemplate
+
+    parser = PydanticOutputParser(pydantic_object=SubtitlesChanges)
 
     prompt_template = PromptTemplate(template="""
-            Rate similarity between two versions of subtitles for video between 0% and 100%.
+            For every numbered pair of transcription subtitles and OCR subtitles of the same moment of a video list the changes between them.
             Ignore minor changes like mismatch between single letters.
-            Transcription subtitles:\n{transcription_subtitles}\n
-            OCR subtitles:\n{ocr_subtitles}\n
+            Pairs:\n{pairs}\n
             Format:\n{format_instructions}
         """,
-        input_variables=["transcription_subtitles", "ocr_subtitles"],
+        input_variables=["pairs"],
         partial_variables={"format_instructions": parser.get_format_instructions()})
 
-    chain = prompt_template | open_ai_llm_mini | parser
+    chain = checked_chain(prompt_template, open_ai_llm_mini(), parser)
     response = chain.invoke({
-        "transcription_subtitles": transcription,
-        "ocr_subtitles": ocr_subtitles})
+        "pairs": "\n".join(
+            f"{index}. Transcription: {transcription_text}\n   OCR: {ocr_text}"
+            for index, (transcription_text, ocr_text) in enumerate(pairs, start=1)
+        )
+    })
+
+    return response.changes
+
+
+def compare_subtitles(transcription, ocr, llm_threshold=SUBTITLES_LLM_THRESHOLD):
+    if not transcription or not ocr:
+        return SubtitlesAnalysis(subtitles_similarity=0, changes=[])
+
+    pairs = align(transcription, ocr)
+
+    total_length = 0
+    weighted_similarity = 0.0
+    changes = []
+    ambiguous = []
+    without_subtitles = 0
+    for transcription_text, ocr_text in pairs:
+        length = max(len(transcription_text), len(ocr_text))
+        total_length += length
+        if not ocr_text:
+            without_subtitles += 1
+            continue
+        if not transcription_text:
+            changes.append(f"'{ocr_text}' shown in subtitles but not said")
+            continue
+
+        ratio = similarity(normalize(transcription_text), normalize(ocr_text))
+        weighted_similarity += ratio * length
+        if ratio < llm_threshold:
+            ambiguous.append((transcription_text, ocr_text))
+        else:
+            changes.extend(word_changes(transcription_text, ocr_text))
+
+    if ambiguous:
+        changes.extend(explain_changes(ambiguous))
+    if without_subtitles:
+        changes.append(f"{without_subtitles} transcription segments have no subtitles on screen")
 
-    return response
+    return SubtitlesAnalysis(
+        subtitles_similarity=round(100 * weighted_similarity / total_length) if total_length else 0,
+        changes=changes
+    )
@@ -2,13 +2,15 @@ from pydantic import BaseModel, ValidationError
 import os
 from typing import List, Optional
 
-from audio import extract_audio_file, transcribe
+from audio import extract_audio, transcribe
 from controller.core import app
 from flask import Blueprint, request, jsonify
 
 from transcript_analysis_models import analyze_segments_comparatively, analyze_segment, analyze_transcription, \
     FactDetail
 from fact_check_models import verify_facts
+from rate_limits import interactive
+from uploads import save_upload
 from util import segment_transcript
 
 
@@ -17,6 +19,7 @@ class SegmentDTO(BaseModel):
     current_segment: str
 
 @app.route('/test_ai_segment_comparatively', methods=['POST'])
+@interactive
 def test_compare_segments_analisis():
     try:
         # Parse and validate incoming request data
@@ -37,6 +40,7 @@ def test_compare_segments_analisis():
         return jsonify({'error': 'An error occurred during analysis.', 'reason': str(e)}), 500
 
 @app.route('/test_ai_segment', methods=['POST'])
+@interactive
 def test_segments_analisis():
     try:
         # Parse and validate incoming request data
@@ -62,6 +66,7 @@ class TranscriptDTO(BaseModel):
     transcript: str
 
 @app.route('/test_ai_transcript', methods=['POST'])
+@interactive
 def test_segments_transcript():
     try:
         # Parse and validate incoming request data
@@ -95,13 +100,11 @@ def test_transcribe():
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
 
-    video_path = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-    file.save(video_path)
+    _, video_path = save_upload(file, app.config['UPLOAD_FOLDER'], os.path.splitext(file.filename)[1])
 
-    audio_path = os.path.splitext(video_path)[0] + '.wav'
-    extract_audio_file(audio_path, video_path)
+    audio = extract_audio(video_path)
 
-    transcription,segments = transcribe(audio_path)
+    transcription,segments = transcribe(audio)
 
     return jsonify({"segments": segments, "transcription": transcription}), 200
 
@@ -111,6 +114,7 @@ class FactsVerificationDTO(BaseModel):
     facts_to_verify: List[FactDetail]
 
 @app.route('/test_facts_verification', methods=['POST'])
+@interactive
 def test_facts_verification():
     try:
         # Parse and validate incoming request data
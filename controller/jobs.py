@@ -0,0 +1,94 @@
+import os, datetime
+
+from flask import request, jsonify
+from flask_cors import cross_origin
+
+from cache import bypass_response_cache
+from controller.core import app
+from jobs import JobStore, JobQueue, QueueFull
+from person_boxes import format_persons
+from pipeline import is_complete, process_video_file, video_stages
+from results import get_or_compute
+from uploads import save_upload
+
+
+def run_video_job(job, on_stage_done):
+    params = job["params"]
+
+    def analyze():
+        with bypass_response_cache(params["no_cache"]):
+            return process_video_file(params["video_path"], max_workers=app.config['PIPELINE_MAX_WORKERS'],
+                                      on_stage_done=on_stage_done)
+
+    result = get_or_compute(params["content_hash"], analyze, refresh=params["no_cache"], is_complete=is_complete)
+
+    return app.json.dumps({
+        'file_id': params["file_id"],
+        'name': params["name"],
+        'creation_time': datetime.datetime.fromtimestamp(job["created_at"]),
+        **result,
+        "video_url": "/get_video/{filename}".format(filename=params["file_id"])
+    })
+
+
+job_queue = JobQueue(
+    JobStore(os.environ.get('JOB_STORE_PATH', os.path.join('cache', 'jobs.sqlite'))),
+    run_video_job,
+    workers=int(os.environ.get('JOB_WORKERS', 2)),
+    max_queued=int(os.environ.get('JOB_MAX_QUEUED', 20))
+)
+
+
+@app.route('/jobs', methods=['POST'])
+@cross_origin()
+def submit_job():
+    if 'video_file' not in request.files:
+        return jsonify({'error': 'No file part'}), 400
+
+    file = request.files['video_file']
+
+    if file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+
+    if job_queue.depth() >= job_queue.max_queued:
+        return jsonify({'error': 'Too many queued jobs, try again later'}), 429
+
+    content_hash, video_path = save_upload(file, app.config['UPLOAD_FOLDER'])
+    file_id = os.path.basename(video_path)
+
+    try:
+        job_id = job_queue.submit(
+            {
+                "video_path": video_path,
+                "content_hash": content_hash,
+                "file_id": file_id,
+                "name": file.filename,
+                "no_cache": request.args.get('no_cache') == '1',
+            },
+            [stage.name for stage in video_stages(video_path)]
+        )
+    except QueueFull:
+        return jsonify({'error': 'Too many queued jobs, try again later'}), 429
+
+    return jsonify({'job_id': job_id, 'status_url': '/jobs/{job_id}'.format(job_id=job_id)}), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    stages = job["stages"]
+    result = job["result"]
+    if result is not None:
+        result["detected_persons"] = format_persons(result["detected_persons"], request.args.get('persons_format', 'columnar'))
+
+    return jsonify({
+        'job_id': job["id"],
+        'status': job["status"],
+        'stages': stages,
+        'progress': 1 if job["status"] == "done" else sum(state == "done" for state in stages.values()) / len(stages),
+        'result': result,
+        'error': job["error"],
+    }), 200
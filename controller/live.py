@@ -0,0 +1,90 @@
+from flask import request, jsonify, Response
+from flask_cors import cross_origin
+
+from controller.core import app
+from controller.video import server_sent_event
+from live import live_sessions, StreamEnded, TooManySessions
+
+
+# Starts a live session. ?format= is s16le or f32le for raw 16 kHz mono PCM, or the ffmpeg
+# format of the chunks (webm, mpegts, ...), by default ffmpeg detects it.
+@app.route('/live', methods=['POST'])
+@cross_origin()
+def start_live_session():
+    try:
+        session = live_sessions.create(request.args.get('format', 'auto'))
+    except TooManySessions:
+        return jsonify({'error': 'Too many live sessions, try again later'}), 429
+
+    return jsonify({
+        'session_id': session.id,
+        'chunks_url': '/live/{session_id}/chunks'.format(session_id=session.id),
+        'end_url': '/live/{session_id}/end'.format(session_id=session.id),
+        'events_url': '/live/{session_id}/events'.format(session_id=session.id),
+    }), 201
+
+
+# Appends the request body to the stream. The body can be one chunk or a long chunked
+# upload that is read as it arrives.
+@app.route('/live/<session_id>/chunks', methods=['POST'])
+@cross_origin()
+def add_live_chunks(session_id):
+    session = live_sessions.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Live session not found'}), 404
+
+    try:
+        while True:
+            chunk = request.stream.read(64 * 1024)
+            if not chunk:
+                break
+            session.write(chunk)
+    except StreamEnded:
+        return jsonify({'error': 'Live session has ended'}), 409
+
+    return jsonify({'received_seconds': session.received_seconds}), 200
+
+
+@app.route('/live/<session_id>/end', methods=['POST'])
+@cross_origin()
+def end_live_session(session_id):
+    session = live_sessions.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Live session not found'}), 404
+
+    session.end()
+    return jsonify({'events_url': '/live/{session_id}/events'.format(session_id=session.id)}), 202
+
+
+# Server-Sent Events of the session, from the start or after the Last-Event-ID of a
+# reconnecting client, until the "end" event
+@app.route('/live/<session_id>/events', methods=['GET'])
+@cross_origin()
+def live_session_events(session_id):
+    session = live_sessions.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Live session not found'}), 404
+
+    last_event_id = request.headers.get('Last-Event-ID', '0')
+    last_event_id = int(last_event_id) if last_event_id.isdigit() else 0
+    # Nothing more will come, 204 stops EventSource from reconnecting
+    if session.finished_at is not None and last_event_id >= session.last_event_id:
+        return '', 204
+
+    def stream():
+        after_id = last_event_id
+        while True:
+            events = session.events_after(after_id, timeout=15)
+            if not events and session.finished_at is not None:
+                return
+            if not events:
+                yield ": keepalive\n\n"
+                continue
+            for event_id, event, data in events:
+                yield server_sent_event(event, data, event_id)
+                if event == "end":
+                    return
+            after_id = events[-1][0]
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
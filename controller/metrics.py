@@ -0,0 +1,15 @@
+from flask import Response
+
+from cache import embedding_cache
+from controller.core import app
+from controller.jobs import job_queue
+from metrics import Gauge, registry
+
+registry.register(Gauge("job_queue_depth", "Background jobs waiting for a worker", job_queue.depth))
+registry.register(Gauge("embedding_cache_memory_entries", "Embedding vectors kept in memory",
+                        lambda: len(embedding_cache.memory)))
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
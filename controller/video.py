@@ -1,18 +1,17 @@
-import os, uuid, datetime
+import contextvars, os, datetime, queue, threading
 
-from flask import request, jsonify, send_from_directory
+from flask import request, jsonify, send_from_directory, Response
 from flask_cors import cross_origin
 
-from ask_questions import ask_questions
+from cache import bypass_response_cache
 from controller.core import app
-from audio import extract_audio_file, transcribe
-from emotions import detect_emotions
-from offtopic import detect_off_topic_using_embeddings
-from summary import write_summary
-from transcript_analysis_models import analyze_transcription, analyze_segments_comparatively, EventAnalysis, \
-    analyze_segment, AnalysisResult
-from video_ai import analyze_video
-from compare_subtitles import compare_subtitles
+from person_boxes import format_persons
+from pipeline import is_complete, process_video_file, STAGE_EVENTS
+from metrics import collect_timings
+from rate_limits import llm_scheduler
+from results import get_or_compute, result_store
+from uploads import save_upload
+from whisper_models import whisper_models
 
 
 @app.route('/', methods=['GET'])
@@ -25,11 +24,74 @@ def health_check_POST():
     # You can add any logic here to verify your app's health
     return jsonify(status="healthy"), 200
 
+@app.route('/whisper_models', methods=['GET'])
+def whisper_models_stats():
+    return jsonify(whisper_models.stats()), 200
+
+@app.route('/llm_rate_limits', methods=['GET'])
+def llm_rate_limits_stats():
+    return jsonify(llm_scheduler.stats()), 200
+
 @app.route('/get_video/<filename>', methods=['GET'])
 def get_video(filename):
     path = os.path.abspath(app.config['UPLOAD_FOLDER'])
     return send_from_directory(path, filename)
 
+@app.route('/detected_persons/<file_id>', methods=['GET'])
+def get_detected_persons(file_id):
+    persons = result_store.persons_npz(os.path.splitext(file_id)[0])
+    if persons is None:
+        return jsonify({'error': 'Analysis not found'}), 404
+
+    return Response(
+        persons,
+        mimetype='application/octet-stream',
+        headers={'Content-Disposition': 'attachment; filename={name}.npz'.format(name=os.path.splitext(file_id)[0])}
+    )
+
+@app.route('/analysis/<file_id>', methods=['GET'])
+def get_analysis(file_id):
+    key = os.path.splitext(file_id)[0]
+    fields = set(filter(None, request.args.get('fields', '').split(','))) or None
+    persons_format = request.args.get('persons_format', 'columnar')
+
+    etag = result_store.etag(key, fields)
+    if etag is None:
+        return jsonify({'error': 'Analysis not found'}), 404
+    etag = "{etag}-{persons_format}".format(etag=etag, persons_format=persons_format)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    unknown = sorted((fields or set()) - (result_store.fields(key) or set()))
+    if unknown:
+        return jsonify({'error': 'Unknown fields: {fields}'.format(fields=', '.join(unknown))}), 400
+
+    result = result_store.get(key, fields)
+    if "detected_persons" in result:
+        result["detected_persons"] = format_persons(result["detected_persons"], persons_format)
+
+    response = jsonify({
+        'file_id': file_id,
+        **result,
+        "video_url": "/get_video/{filename}".format(filename=file_id)
+    })
+    response.set_etag(etag)
+    # Clients keep the analysis and revalidate it with If-None-Match
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def video_response(file_id, name, result, persons_format):
+    return {
+        'file_id': file_id,
+        'name': name,
+        'creation_time': datetime.datetime.now(),
+        **result,
+        "detected_persons": format_persons(result["detected_persons"], persons_format),
+        "video_url": "/get_video/{filename}".format(filename=file_id)
+    }
+
 @app.route('/process_video', methods=['POST'])
 @cross_origin()
 def process_video():
@@ -41,62 +103,84 @@ def process_video():
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
 
-    file_id = str(uuid.uuid4()) + ".mp4"
-
-    video_path = os.path.join(app.config['UPLOAD_FOLDER'], file_id)
-    file.save(video_path)
-
-    audio_path = os.path.splitext(video_path)[0] + '.wav'
-    extract_audio_file(audio_path, video_path)
-
-    transcription,segments = transcribe(audio_path)
-
-    main_subject, off_topic_segments = detect_off_topic_using_embeddings(transcription)
-    quality_metrics = analyze_transcription(segments)
-
-    # Perform comparative analysis for each pair of consecutive segments
-    events = []
-    for i in range(1, len(segments)):
-        event_analysis = analyze_segments_comparatively(segments[i - 1], segments[i])
-        event_record = EventAnalysis(
-            index=i,
-            from_segment=i - 1,
-            to_segment=i,
-            event_analysis=event_analysis
-        )
-        events.append(event_record)
-    # Analyze each segment independently
-    segments_analysis = []
-    for segment in segments:
-        analysis = analyze_segment(segment["text"])
-        segments_analysis.append(analysis)
-
-    analysis = AnalysisResult(
-        main_subject=main_subject,
-        off_topic_segments=off_topic_segments,
-        quality_metrics=quality_metrics
+    content_hash, video_path = save_upload(file, app.config['UPLOAD_FOLDER'])
+    file_id = os.path.basename(video_path)
+    no_cache = request.args.get('no_cache') == '1'
+
+    def analyze():
+        with bypass_response_cache(no_cache):
+            return process_video_file(video_path, max_workers=app.config['PIPELINE_MAX_WORKERS'])
+
+    with collect_timings() as timings:
+        result = get_or_compute(content_hash, analyze, refresh=no_cache, is_complete=is_complete)
+
+    response = video_response(file_id, file.filename, result, request.args.get('persons_format', 'columnar'))
+    if request.args.get('timings') == '1':
+        response["timings"] = timings.to_dict()
+    return jsonify(response)
+
+def server_sent_event(event, data, event_id=None):
+    # Every line of the JSON gets its own data field, the client joins them back
+    lines = app.json.dumps(data).splitlines()
+    fields = ["id: {event_id}".format(event_id=event_id)] if event_id is not None else []
+    fields.append("event: {event}".format(event=event))
+    fields.extend("data: " + line for line in lines)
+    return "\n".join(fields) + "\n\n"
+
+# Same as /process_video, but answers with Server-Sent Events as soon as parts of the result
+# are ready: "upload", then one event per finished stage (named after the stage),
+# "segment_analysis" and "event" for every segment, and "result" with the whole response.
+@app.route('/process_video_stream', methods=['POST'])
+@cross_origin()
+def process_video_stream():
+    if 'video_file' not in request.files:
+        return jsonify({'error': 'No file part'}), 400
 
-    )
+    file = request.files['video_file']
 
-    detected_subtitles, bounding_boxes = analyze_video(video_path)
-    subtitles_matching = compare_subtitles(segments, detected_subtitles)
-    emotions, duration = detect_emotions(video_path)
-    questions = ask_questions(transcription)
-    summary = write_summary(transcription)
+    if file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
 
-    return jsonify({
-        'file_id': file_id,
-        'name': file.filename,
-        'creation_time': datetime.datetime.now(),
-        'duration': duration,
-        'transcription': segments,
-        'analysis': analysis.dict(),
-        "segments_analysis": [segment_analysis.dict() for segment_analysis in segments_analysis],
-        "events": [event.dict() for event in events],
-        "subtitles_matching": subtitles_matching.dict(),
-        # "emotions": emotions,
-        "questions": questions.dict()["questions"],
-        "summary": summary.dict()["summary"],
-        "detected_persons": bounding_boxes,
-        "video_url": "/get_video/{filename}".format(filename=file_id)
-    })
+    content_hash, video_path = save_upload(file, app.config['UPLOAD_FOLDER'])
+    file_id = os.path.basename(video_path)
+    name = file.filename
+    no_cache = request.args.get('no_cache') == '1'
+    persons_format = request.args.get('persons_format', 'columnar')
+    events = queue.Queue()
+
+    def on_stage_done(stage_name, result):
+        if stage_name in STAGE_EVENTS:
+            events.put((stage_name, STAGE_EVENTS[stage_name](result)))
+
+    def analyze():
+        with bypass_response_cache(no_cache):
+            return process_video_file(video_path, max_workers=app.config['PIPELINE_MAX_WORKERS'],
+                                      on_stage_done=on_stage_done, on_partial=lambda *event: events.put(event))
+
+    # The analysis runs on its own thread and is stored even when the client goes away
+    def run():
+        try:
+            result = get_or_compute(content_hash, analyze, refresh=no_cache, is_complete=is_complete)
+            events.put(("result", video_response(file_id, name, result, persons_format)))
+        except Exception as e:
+            events.put(("error", {'error': 'An error occurred during analysis.', 'reason': str(e)}))
+        events.put(None)
+
+    threading.Thread(target=contextvars.copy_context().run, args=(run,), daemon=True).start()
+
+    def stream():
+        yield server_sent_event("upload", {'file_id': file_id, 'name': name,
+                                           "video_url": "/get_video/{filename}".format(filename=file_id)})
+        while True:
+            try:
+                event = events.get(timeout=15)
+            except queue.Empty:
+                # Keeps proxies from closing the connection during long stages
+                yield ": keepalive\n\n"
+                continue
+            if event is None:
+                return
+            yield server_sent_event(*event)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -1,6 +1,32 @@
+import numpy as np
+
+from cache import embedding_cache
 from llm_models import embeddings
+from metrics import observe_cache_lookups
+
+# OpenAI accepts at most 2048 inputs per embeddings request
+EMBEDDINGS_BATCH_SIZE = 1000
 
 
 def get_embeddings(text):
-    embedding = embeddings.embed_query(text)
-    return embedding
+    return get_embeddings_batch([text])[0]
+
+
+# Only texts missing from the embedding cache are sent to the provider. Returns one float32
+# array per text.
+def get_embeddings_batch(texts, batch_size=EMBEDDINGS_BATCH_SIZE):
+    model = embeddings().model
+    vectors = embedding_cache.get_many(model, texts)
+
+    hits = sum(vector is not None for vector in vectors)
+    observe_cache_lookups("embedding", model, hits, len(vectors) - hits)
+
+    missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+    fetched = {}
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        batch_vectors = embeddings().embed_documents(batch)
+        embedding_cache.put_many(model, batch, batch_vectors)
+        fetched.update(zip(batch, np.asarray(batch_vectors, dtype=np.float32)))
+
+    return [fetched[text] if vector is None else vector for text, vector in zip(texts, vectors)]
@@ -1,42 +1,167 @@
-import cv2
-# import os, math
-# from google.cloud import vision
+import importlib
+import json
+import math
+import os
+import subprocess
+from collections import defaultdict
 
+from process_pools import SpawnedPool
+
+# Frames analyzed per second of video. Off by default, decoding frames competes with Whisper
+# for the CPU.
+EMOTIONS_SAMPLE_RATE = float(os.environ.get('EMOTIONS_SAMPLE_RATE', 0))
+EMOTIONS_WORKERS = int(os.environ.get('EMOTIONS_WORKERS', max((os.cpu_count() or 2) // 2, 1)))
+EMOTIONS_BATCH_SIZE = int(os.environ.get('EMOTIONS_BATCH_SIZE', 16))
+# "vision", "faces" (face counts only, no emotions) or "package.module:ClassName" of a custom model
+EMOTIONS_MODEL = os.environ.get('EMOTIONS_MODEL', 'vision')
+
+
+class FaceCountModel:
+    # Local model without emotions, reports the number of faces found by OpenCV's Haar cascade
+    def __init__(self):
+        import cv2
+
+        self.classifier = cv2.CascadeClassifier(os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml"))
+
+    def predict(self, frames):
+        import cv2
+
+        scores = []
+        for frame in frames:
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            scores.append({"faces": float(len(self.classifier.detectMultiScale(gray, 1.1, 5)))})
+        return scores
+
+
+class VisionEmotionModel:
+    # Google Vision face detection, one batched request per batch of frames. Likelihoods are
+    # mapped to scores from 0 (VERY_UNLIKELY) to 1 (VERY_LIKELY) and averaged over faces.
+    likelihood_scores = {0: None, 1: 0.0, 2: 0.25, 3: 0.5, 4: 0.75, 5: 1.0}
+
+    def __init__(self):
+        from google.cloud import vision
+
+        self.vision = vision
+        self.client = vision.ImageAnnotatorClient()
+
+    def predict(self, frames):
+        import cv2
+
+        requests = [
+            self.vision.AnnotateImageRequest(
+                image=self.vision.Image(content=cv2.imencode(".jpg", frame)[1].tobytes()),
+                features=[self.vision.Feature(type_=self.vision.Feature.Type.FACE_DETECTION)]
+            )
+            for frame in frames
+        ]
+        responses = self.client.batch_annotate_images(requests=requests).responses
+
+        scores = []
+        for response in responses:
+            faces = response.face_annotations
+            frame_scores = {"faces": float(len(faces))}
+            for emotion in ["joy", "sorrow", "anger", "surprise"]:
+                values = [self.likelihood_scores[getattr(face, f"{emotion}_likelihood")] for face in faces]
+                values = [value for value in values if value is not None]
+                if values:
+                    frame_scores[emotion] = sum(values) / len(values)
+            scores.append(frame_scores)
+        return scores
+
+
+_models = {}
 
-def detect_emotions(video_path):
-    vidcap = cv2.VideoCapture(video_path)
 
-    # client = vision.ImageAnnotatorClient()
-    # frame_rate = vidcap.get(cv2.CAP_PROP_FPS)
-    # while vidcap.isOpened():
-    #     frame_id = vidcap.get(1)  # current frame number
-    #     ret, frame = vidcap.read()
-    #     if not ret:
-    #         break
-    #
-    #     if frame_id % math.floor(frame_rate) == 0:
-    #         print("Processing frame {frame_id}".format(frame_id=frame_id))
-    #         image = vision.Image(content=frame)
-    #         response = client.face_detection(image=image)
-    #         faces = response.face_annotations
-    #         likelihood_name = (
-    #             "UNKNOWN",
-    #             "VERY_UNLIKELY",
-    #             "UNLIKELY",
-    #             "POSSIBLE",
-    #             "LIKELY",
-    #             "VERY_LIKELY",
-    #         )
-    #         for face in faces:
-    #             print(f"anger: {likelihood_name[face.anger_likelihood]}")
-    #             print(f"joy: {likelihood_name[face.joy_likelihood]}")
-    #             print(f"surprise: {likelihood_name[face.surprise_likelihood]}")
-    #
-    #         path = os.path.abspath("frames/frame%d.jpg" % int(frameId))
-    #         cv2.imwrite(path, frame)
+def load_emotion_model(spec):
+    if spec not in _models:
+        if spec == "faces":
+            _models[spec] = FaceCountModel()
+        elif spec == "vision":
+            _models[spec] = VisionEmotionModel()
+        else:
+            module_name, class_name = spec.split(":")
+            _models[spec] = getattr(importlib.import_module(module_name), class_name)()
+    return _models[spec]
 
+
+# Duration from the container metadata, nothing is decoded
+def video_duration(video_path):
+    try:
+        output = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "json", video_path],
+            check=True, capture_output=True
+        ).stdout
+        return float(json.loads(output)["format"]["duration"])
+    except (OSError, subprocess.CalledProcessError, KeyError, ValueError):
+        import cv2
+
+        vidcap = cv2.VideoCapture(video_path)
+        fps = vidcap.get(cv2.CAP_PROP_FPS)
+        frame_count = int(vidcap.get(cv2.CAP_PROP_FRAME_COUNT))
+        vidcap.release()
+        return frame_count / fps if fps else 0.0
+
+
+# Runs the model on frames sampled at sample_rate between start and end seconds. Frames in
+# between are skipped with grab(), which doesn't decode them. Returns (time, scores) pairs.
+def sample_range(video_path, start, end, sample_rate, model_spec, batch_size):
+    import cv2
+
+    model = load_emotion_model(model_spec)
+    vidcap = cv2.VideoCapture(video_path)
     fps = vidcap.get(cv2.CAP_PROP_FPS)
-    frame_count = int(vidcap.get(cv2.CAP_PROP_FRAME_COUNT))
-    duration = frame_count/fps
+    step = max(fps / sample_rate, 1)
+
+    frame_id = int(math.ceil(start * fps))
+    end_frame = int(math.ceil(end * fps))
+    next_sample = frame_id
+    vidcap.set(cv2.CAP_PROP_POS_FRAMES, frame_id)
+
+    samples = []
+    times = []
+    frames = []
+    while frame_id < end_frame and vidcap.grab():
+        if frame_id >= next_sample:
+            ret, frame = vidcap.retrieve()
+            if ret:
+                times.append(frame_id / fps)
+                frames.append(frame)
+            next_sample += step
+            if len(frames) == batch_size:
+                samples.extend(zip(times, model.predict(frames)))
+                times, frames = [], []
+        frame_id += 1
+
+    if frames:
+        samples.extend(zip(times, model.predict(frames)))
     vidcap.release()
-    return None, duration
+    return samples
+
+
+_pool = SpawnedPool()
+
+
+# Averages the scores of all frames sampled in the same second of the video
+def per_second_timeline(samples):
+    seconds = defaultdict(lambda: defaultdict(list))
+    for time, scores in samples:
+        for name, value in scores.items():
+            seconds[int(time)][name].append(value)
+    return [
+        {"second": second, **{name: sum(values) / len(values) for name, values in seconds[second].items()}}
+        for second in sorted(seconds)
+    ]
+
+
+def detect_emotions(video_path, sample_rate=EMOTIONS_SAMPLE_RATE, model_spec=EMOTIONS_MODEL):
+    duration = video_duration(video_path)
+    if sample_rate <= 0 or duration <= 0:
+        return None, duration
+
+    # Split the video into one time range per worker
+    ranges = EMOTIONS_WORKERS
+    bounds = [duration * index / ranges for index in range(ranges + 1)]
+    calls = [(sample_range, video_path, start, end, sample_rate, model_spec, EMOTIONS_BATCH_SIZE)
+             for start, end in zip(bounds, bounds[1:])]
+    samples = [sample for range_samples in _pool.run(calls, EMOTIONS_WORKERS) for sample in range_samples]
+    return per_second_timeline(samples), duration
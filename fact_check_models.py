@@ -1,11 +1,16 @@
+import os
+from functools import lru_cache
 from typing import List, Optional
 from enum import Enum
 
-from langchain_core.output_parsers import PydanticOutputParser
-from langchain_core.prompts import PromptTemplate
+import numpy as np
 from pydantic import BaseModel, Field
 
-from llm_models import open_ai_llm_mini, open_ai_llm, command_r_plus_llm
+from embeddings import get_embeddings_batch
+from llm_models import checked_chain, open_ai_llm_mini, open_ai_llm, command_r_plus_llm
+
+# Facts with embeddings at least this similar are verified once, 1 verifies every fact separately
+FACT_CLUSTER_THRESHOLD = float(os.environ.get('FACT_CLUSTER_THRESHOLD', 0.92))
 
 
 class FactStatus(str, Enum):
@@ -31,8 +36,11 @@ class FactCheckResult(BaseModel):
     data: List[FactCheck]
 
 
-# Function to analyze a single segment independently
-def verify_facts(facts: List[str]) -> List[FactCheck]:
+@lru_cache(maxsize=None)
+def fact_check_chain():
+    from langchain_core.output_parsers import PydanticOutputParser
+    from langchain_core.prompts import PromptTemplate
+
     parser = PydanticOutputParser(pydantic_object=FactCheck)
 
     prompt_template = PromptTemplate(template="""
@@ -55,14 +63,53 @@ def verify_facts(facts: List[str]) -> List[FactCheck]:
      partial_variables={"format_instructions": parser.get_format_instructions()},
    )
 
-    chain = prompt_template | command_r_plus_llm | parser
+    return checked_chain(prompt_template, command_r_plus_llm(), parser)
 
 
-    facts_checks = []
-    for index, f in enumerate(facts):
-        response = chain.invoke({"fact": f})
-        facts_checks.append(response.dict())
+# Groups facts whose embeddings are at least `threshold` similar. Every fact joins the cluster
+# of the first earlier leader it is similar to, or leads a new cluster when there is none (even
+# with an empty embedding). Returns the index of the cluster leader per fact.
+def cluster_facts(facts: List[str], threshold: float = FACT_CLUSTER_THRESHOLD) -> List[int]:
+    vectors = np.asarray(get_embeddings_batch(facts), dtype=np.float32)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    similar = (vectors @ vectors.T) >= threshold
+
+    leaders = np.full(len(facts), -1)
+    for index in range(len(facts)):
+        if leaders[index] == -1:
+            leaders[index] = index
+            leaders[(leaders == -1) & similar[index]] = index
+    return leaders.tolist()
+
 
+# Verifies every cluster of near-duplicate facts once, with at most max_concurrency checks
+# running at the same time. Results are in the order of `facts`, a failed check is reported
+# with an "error" for the facts of its cluster.
+def verify_facts(facts: List[str], max_concurrency: int = 8,
+                 threshold: float = FACT_CLUSTER_THRESHOLD) -> List[dict]:
+    if not facts:
+        return []
+
+    leaders = cluster_facts(facts, threshold) if threshold < 1 else list(range(len(facts)))
+    unique_leaders = list(dict.fromkeys(leaders))
+
+    responses = fact_check_chain().batch(
+        [{"fact": facts[leader]} for leader in unique_leaders],
+        config={"max_concurrency": max_concurrency},
+        return_exceptions=True
+    )
+    verdicts = dict(zip(unique_leaders, responses))
+
+    facts_checks = []
+    for index, (fact, leader) in enumerate(zip(facts, leaders)):
+        response = verdicts[leader]
+        if isinstance(response, Exception):
+            fact_check = {"fact": fact, "details": None, "error": str(response)}
+        else:
+            fact_check = {**response.dict(), "fact": fact}
+        if leader != index:
+            fact_check["verified_as"] = facts[leader]
+        facts_checks.append(fact_check)
 
     return facts_checks
 
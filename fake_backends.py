@@ -0,0 +1,152 @@
+import datetime
+import json
+import os
+import random
+import subprocess
+import tempfile
+import time
+from types import SimpleNamespace
+
+# Deterministic local stand-ins for the hosted models, used by benchmark.py and for working
+# offline. FAKE_BACKENDS lists the ones to use instead of the real services: "llm" (chat
+# models and embeddings of llm_models), "video" (Video Intelligence) and "whisper".
+FAKE_BACKENDS = set(filter(None, os.environ.get('FAKE_BACKENDS', '').split(',')))
+
+# Latency of every fake: `latency` seconds per request plus a cost per prompt/completion
+# token, per second of video or audio. Prices are in USD per million tokens and only used
+# to report the cost of a benchmark run.
+DEFAULT_PROFILES = {
+    "gpt-4o": {"latency": 0.8, "seconds_per_prompt_token": 0.00002, "seconds_per_completion_token": 0.015,
+               "prompt_price": 2.5, "completion_price": 10.0},
+    "gpt-4o-mini": {"latency": 0.4, "seconds_per_prompt_token": 0.00001, "seconds_per_completion_token": 0.008,
+                    "prompt_price": 0.15, "completion_price": 0.6},
+    "command-r-plus": {"latency": 0.6, "seconds_per_prompt_token": 0.00002, "seconds_per_completion_token": 0.012,
+                       "prompt_price": 2.5, "completion_price": 10.0},
+    "text-embedding-ada-002": {"latency": 0.15, "seconds_per_prompt_token": 0.000002, "prompt_price": 0.1},
+    "video_intelligence": {"latency": 5.0, "seconds_per_video_second": 0.3},
+    "whisper": {"latency": 0.5, "seconds_per_audio_second": 0.05},
+}
+# JSON object merged over DEFAULT_PROFILES, e.g. {"gpt-4o": {"latency": 2.0}}
+FAKE_BACKEND_PROFILES = {**DEFAULT_PROFILES, **json.loads(os.environ.get('FAKE_BACKEND_PROFILES', '{}'))}
+# Multiplies every fake latency, 0 answers immediately
+FAKE_LATENCY_SCALE = float(os.environ.get('FAKE_LATENCY_SCALE', 1))
+
+WORDS = [
+    "dzisiaj", "omówimy", "budżet", "miasta", "nowy", "projekt", "szkoła", "transport", "zieleń", "mieszkańcy",
+    "inwestycja", "rozwój", "plan", "rok", "program", "kultura", "sport", "zdrowie", "bezpieczeństwo", "energia",
+]
+SENTENCE_SECONDS = 4.0
+
+
+def enabled(name):
+    return name in FAKE_BACKENDS
+
+
+def profile(name):
+    return FAKE_BACKEND_PROFILES.get(name, {})
+
+
+def simulate_latency(name, **amounts):
+    settings = profile(name)
+    seconds = settings.get("latency", 0.0) + sum(settings.get(f"seconds_per_{unit}", 0.0) * amount
+                                                 for unit, amount in amounts.items())
+    if seconds > 0 and FAKE_LATENCY_SCALE > 0:
+        time.sleep(seconds * FAKE_LATENCY_SCALE)
+
+
+def sentence(index):
+    rng = random.Random(index)
+    words = [rng.choice(WORDS) for _ in range(rng.randint(6, 12))]
+    return " ".join(words).capitalize() + "."
+
+
+# What is said in a synthetic video: one sentence every SENTENCE_SECONDS seconds, the
+# same for every video of the same length. Returns (start, end, text) tuples.
+def script(duration):
+    lines = []
+    start = 0.0
+    index = 0
+    while start < duration:
+        end = min(start + SENTENCE_SECONDS, duration)
+        lines.append((start, end, sentence(index)))
+        start = end
+        index += 1
+    return lines
+
+
+def media_duration(path):
+    from emotions import video_duration
+
+    return video_duration(path)
+
+
+class FakeWhisperModel:
+    # Transcribes any audio to the synthetic script of its length
+    def __init__(self, name):
+        self.name = name
+
+    def transcribe(self, audio, **kwargs):
+        from audio import SAMPLE_RATE
+
+        duration = media_duration(audio) if isinstance(audio, str) else len(audio) / SAMPLE_RATE
+        simulate_latency("whisper", audio_second=duration)
+        segments = [{"text": " " + text, "start": start, "end": end} for start, end, text in script(duration)]
+        return {"text": "".join(segment["text"] for segment in segments), "segments": segments}
+
+
+def _offset(seconds):
+    return datetime.timedelta(seconds=seconds)
+
+
+class FakeVideoIntelligenceClient:
+    # Answers annotate_video with the script of the video burned in as bottom subtitles and
+    # one person walking across the frame, in the shape of the Video Intelligence response
+    def annotate_video(self, request):
+        duration = self._duration(request)
+        simulate_latency("video_intelligence", video_second=duration)
+
+        vertices = [SimpleNamespace(x=x, y=y) for x, y in [(0.2, 0.85), (0.8, 0.85), (0.8, 0.95), (0.2, 0.95)]]
+        text_annotations = [
+            SimpleNamespace(text=text, segments=[SimpleNamespace(
+                segment=SimpleNamespace(start_time_offset=_offset(start), end_time_offset=_offset(end)),
+                confidence=0.95,
+                frames=[SimpleNamespace(rotated_bounding_box=SimpleNamespace(vertices=vertices))]
+            )])
+            for start, end, text in script(duration)
+        ]
+        timestamped_objects = [
+            SimpleNamespace(time_offset=_offset(second), normalized_bounding_box=SimpleNamespace(
+                left=0.1 + 0.5 * second / max(duration, 1), top=0.2,
+                right=0.3 + 0.5 * second / max(duration, 1), bottom=0.9))
+            for second in range(int(duration))
+        ]
+        person_detection_annotations = [SimpleNamespace(tracks=[SimpleNamespace(timestamped_objects=timestamped_objects)])]
+
+        result = SimpleNamespace(annotation_results=[SimpleNamespace(
+            text_annotations=text_annotations, person_detection_annotations=person_detection_annotations)])
+        return SimpleNamespace(result=lambda timeout=None: result)
+
+    @staticmethod
+    def _duration(request):
+        uri = request.get("input_uri", "")
+        if uri.startswith("file://"):
+            return media_duration(uri[len("file://"):])
+        if "input_content" in request:
+            with tempfile.NamedTemporaryFile(suffix=".mp4") as file:
+                file.write(request["input_content"])
+                file.flush()
+                return media_duration(file.name)
+        return 60.0
+
+
+# Synthetic test video with a moving test pattern and a tone. Videos with a different seed
+# have different content, so they aren't deduplicated by the result store.
+def create_video(path, duration, seed=0, width=640, height=360, fps=25):
+    command = [
+        "ffmpeg", "-nostdin", "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={fps}",
+        "-f", "lavfi", "-i", f"sine=frequency={220 + 10 * seed}:sample_rate=16000",
+        "-t", str(duration), "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p", "-c:a", "aac", path
+    ]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return path
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import random
+import re
+from typing import ClassVar, List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from fake_backends import WORDS, simulate_latency
+from rate_limited_models import scheduled_request
+from rate_limits import estimate_tokens
+
+# LangChain models of fake_backends. Requests still go through the rate limiter and the
+# metrics, only the provider is replaced.
+
+_SCHEMA_PATTERN = re.compile(r"```\s*(\{.*\})\s*```", re.DOTALL)
+_INDEXED_LINE_PATTERN = re.compile(r"^\s*\d+: ", re.MULTILINE)
+
+
+class _AnswerBuilder:
+    # Builds a JSON instance of the schema a PydanticOutputParser put in the prompt. Lists of
+    # objects get one item per indexed segment of the prompt, one less when the description
+    # asks for pairs of segments, so batched prompts are answered like the real model would.
+    def __init__(self, schema, prompt, rng):
+        self.definitions = schema.get("$defs", {})
+        self.items = max(len(_INDEXED_LINE_PATTERN.findall(prompt)), 1)
+        self.rng = rng
+
+    def build(self, schema, description=""):
+        if "$ref" in schema:
+            return self.build(self.definitions[schema["$ref"].split("/")[-1]], description)
+        if "anyOf" in schema:
+            options = [option for option in schema["anyOf"] if option.get("type") != "null"]
+            return self.build(options[0], description) if options else None
+        if "enum" in schema:
+            return self.rng.choice(schema["enum"])
+        description = schema.get("description", description)
+
+        kind = schema.get("type", "object")
+        if kind == "object":
+            properties = schema.get("properties", {})
+            return {name: self.build(value) for name, value in properties.items()}
+        if kind == "array":
+            item_schema = schema.get("items", {"type": "string"})
+            if "$ref" in item_schema or item_schema.get("type") == "object":
+                count = max(self.items - 1, 1) if "pair" in description else self.items
+            else:
+                count = self.rng.randint(1, 3)
+            return [self.build(item_schema) for _ in range(count)]
+        if kind == "integer":
+            return self.rng.randint(0, 10)
+        if kind == "number":
+            return round(self.rng.random(), 2)
+        if kind == "boolean":
+            return self.rng.random() < 0.5
+        return " ".join(self.rng.choice(WORDS) for _ in range(self.rng.randint(2, 8)))
+
+
+def fake_answer(prompt):
+    rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).hexdigest())
+    match = None
+    for match in _SCHEMA_PATTERN.finditer(prompt):
+        pass
+    if match is None:
+        return " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 8)))
+
+    schema = json.loads(match.group(1))
+    return json.dumps(_AnswerBuilder(schema, prompt, rng).build(schema), ensure_ascii=False)
+
+
+class FakeChatModel(BaseChatModel):
+    provider: str
+    model_name: str
+
+    @property
+    def _llm_type(self):
+        return "fake-chat"
+
+    @property
+    def _identifying_params(self):
+        return {"provider": self.provider, "model_name": self.model_name}
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt = "\n".join(str(message.content) for message in messages)
+        prompt_tokens = estimate_tokens(prompt)
+
+        def call():
+            answer = fake_answer(prompt)
+            completion_tokens = estimate_tokens(answer)
+            simulate_latency(self.model_name, prompt_token=prompt_tokens, completion_token=completion_tokens)
+            return ChatResult(
+                generations=[ChatGeneration(message=AIMessage(content=answer))],
+                llm_output={"token_usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                                            "total_tokens": prompt_tokens + completion_tokens}}
+            )
+
+        return scheduled_request(
+            self.provider, self.model_name, prompt_tokens, call,
+            lambda result: (result.llm_output["token_usage"]["prompt_tokens"],
+                            result.llm_output["token_usage"]["completion_tokens"])
+        )
+
+
+class FakeEmbeddings(Embeddings):
+    provider: ClassVar[str] = "openai"
+    dimensions: ClassVar[int] = 1536
+
+    def __init__(self, model="text-embedding-ada-002"):
+        self.model = model
+
+    @staticmethod
+    def _vector(text):
+        seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:16], 16)
+        vector = np.random.default_rng(seed).standard_normal(FakeEmbeddings.dimensions)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        prompt_tokens = sum(estimate_tokens(text) for text in texts)
+
+        def call():
+            simulate_latency(self.model, prompt_token=prompt_tokens)
+            return [self._vector(text) for text in texts]
+
+        return scheduled_request(self.provider, self.model, prompt_tokens, call, lambda result: (prompt_tokens, 0))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
@@ -0,0 +1,76 @@
+class _Node:
+    __slots__ = ("center", "by_start", "by_end", "left", "right")
+
+    def __init__(self, center, by_start, by_end, left, right):
+        self.center = center
+        self.by_start = by_start
+        self.by_end = by_end
+        self.left = left
+        self.right = right
+
+
+class IntervalIndex:
+    # Static centered interval tree over items with a start and an end time, e.g. the subtitles
+    # returned by analyze_video. overlapping(t0, t1) takes O(log n + k) for k results.
+    def __init__(self, items, start_key="start_time", end_key="end_time"):
+        self.items = sorted(items, key=lambda item: item[start_key])
+        intervals = [(item[start_key], item[end_key], position) for position, item in enumerate(self.items)]
+        self._root = self._build(intervals)
+
+    def _build(self, intervals):
+        if not intervals:
+            return None
+
+        points = sorted(point for start, end, _ in intervals for point in (start, end))
+        center = points[len(points) // 2]
+
+        left, right, here = [], [], []
+        for interval in intervals:
+            if interval[1] < center:
+                left.append(interval)
+            elif interval[0] > center:
+                right.append(interval)
+            else:
+                here.append(interval)
+
+        return _Node(
+            center,
+            sorted(here, key=lambda interval: interval[0]),
+            sorted(here, key=lambda interval: interval[1], reverse=True),
+            self._build(left),
+            self._build(right)
+        )
+
+    # Items whose [start, end] range overlaps [t0, t1], ordered by start time
+    def overlapping(self, t0, t1):
+        positions = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+
+            if t1 < node.center:
+                for start, _, position in node.by_start:
+                    if start > t1:
+                        break
+                    positions.append(position)
+                stack.append(node.left)
+            elif t0 > node.center:
+                for _, end, position in node.by_end:
+                    if end < t0:
+                        break
+                    positions.append(position)
+                stack.append(node.right)
+            else:
+                positions.extend(position for _, _, position in node.by_start)
+                stack.append(node.left)
+                stack.append(node.right)
+
+        return [self.items[position] for position in sorted(positions)]
+
+    def at(self, t):
+        return self.overlapping(t, t)
+
+    def __len__(self):
+        return len(self.items)
@@ -0,0 +1,233 @@
+import json
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+
+# A running job whose owner hasn't renewed its lease for this long is considered abandoned
+# (the process was killed) and is run again by another queue
+JOB_LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', 60))
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobStore:
+    # Jobs with their parameters, per-stage progress and results in a SQLite file, so
+    # queued and interrupted jobs survive a restart. The file is opened on first use,
+    # importing the application doesn't touch the disk.
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connect_lock = threading.Lock()
+        self._db = None
+
+    @property
+    def _connection(self):
+        with self._connect_lock:
+            if self._db is None:
+                self._db = self._connect()
+            return self._db
+
+    def _connect(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                params TEXT NOT NULL,
+                stages TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                owner TEXT,
+                lease_until REAL
+            )
+        """)
+        # Stores created before jobs had owners
+        columns = {row[1] for row in connection.execute("PRAGMA table_info(jobs)")}
+        for column, kind in (("owner", "TEXT"), ("lease_until", "REAL")):
+            if column not in columns:
+                connection.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+        connection.commit()
+        return connection
+
+    def create(self, params, stage_names):
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        stages = {name: "pending" for name in stage_names}
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO jobs (id, status, params, stages, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, "queued", json.dumps(params), json.dumps(stages), now, now)
+            )
+            self._connection.commit()
+        return job_id
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT id, status, params, stages, result, error, created_at, updated_at FROM jobs WHERE id = ?",
+                (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row[0],
+            "status": row[1],
+            "params": json.loads(row[2]),
+            "stages": json.loads(row[3]),
+            "result": json.loads(row[4]) if row[4] is not None else None,
+            "error": row[5],
+            "created_at": row[6],
+            "updated_at": row[7],
+        }
+
+    def update(self, job_id, **fields):
+        if "stages" in fields:
+            fields["stages"] = json.dumps(fields["stages"])
+        if "result" in fields:
+            fields["result"] = fields["result"] if isinstance(fields["result"], str) else json.dumps(fields["result"])
+        fields["updated_at"] = time.time()
+        with self._lock:
+            self._connection.execute(
+                "UPDATE jobs SET {} WHERE id = ?".format(", ".join(f"{name} = ?" for name in fields)),
+                list(fields.values()) + [job_id]
+            )
+            self._connection.commit()
+
+    # Queued jobs and running jobs whose lease has expired, the ones a queue may take over
+    def claimable(self, include_queued=True):
+        statuses = "'queued', 'running'" if include_queued else "'running'"
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT id FROM jobs WHERE status IN ({statuses}) "
+                "AND (status = 'queued' OR lease_until IS NULL OR lease_until < ?) ORDER BY created_at",
+                (time.time(),)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    # Marks the job as running for owner unless another owner holds a valid lease on it,
+    # returns whether it was claimed
+    def claim(self, job_id, owner, lease_seconds):
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.execute(
+                "UPDATE jobs SET status = 'running', owner = ?, lease_until = ?, updated_at = ? WHERE id = ? "
+                "AND (status = 'queued' OR (status = 'running' AND (lease_until IS NULL OR lease_until < ?)))",
+                (owner, now + lease_seconds, now, job_id, now)
+            )
+            self._connection.commit()
+        return cursor.rowcount == 1
+
+    def renew(self, job_ids, owner, lease_seconds):
+        if not job_ids:
+            return
+        with self._lock:
+            self._connection.execute(
+                "UPDATE jobs SET lease_until = ? WHERE owner = ? AND status = 'running' AND id IN ({})".format(
+                    ", ".join("?" * len(job_ids))),
+                [time.time() + lease_seconds, owner] + list(job_ids)
+            )
+            self._connection.commit()
+
+
+class JobQueue:
+    # Runs run_job(job, on_stage_done) for submitted jobs on a fixed number of worker threads.
+    # At most max_queued jobs wait for a worker, further submissions raise QueueFull. Several
+    # processes can share one store: a job runs in the queue that claims it, and its lease is
+    # renewed while it runs so other queues only take over jobs of processes that died.
+    def __init__(self, store, run_job, workers=2, max_queued=20, lease_seconds=JOB_LEASE_SECONDS):
+        self.store = store
+        self.run_job = run_job
+        self.workers = workers
+        self.max_queued = max_queued
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._queue = queue.Queue()
+        self._queued = 0
+        self._lock = threading.Lock()
+        self._threads = []
+        self._running = set()
+
+    # Starts the workers, once per server process. Not done on import, processes that only
+    # import the application (multiprocessing workers, the reloader's watcher) must not run jobs.
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            self._threads.append(threading.Thread(target=self._renew_leases, daemon=True))
+            for _ in range(self.workers):
+                self._threads.append(threading.Thread(target=self._work, daemon=True))
+
+        # Jobs that were queued when the server stopped, or running in a process that died
+        for job_id in self.store.claimable():
+            self._enqueue(job_id)
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, params, stage_names):
+        with self._lock:
+            if self._queued >= self.max_queued:
+                raise QueueFull(f"{self._queued} jobs are already waiting")
+            job_id = self.store.create(params, stage_names)
+            self._queued += 1
+        self._queue.put(job_id)
+        return job_id
+
+    def depth(self):
+        return self._queued
+
+    def _enqueue(self, job_id):
+        with self._lock:
+            self._queued += 1
+        self._queue.put(job_id)
+
+    def _renew_leases(self):
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            with self._lock:
+                running = list(self._running)
+            self.store.renew(running, self.owner, self.lease_seconds)
+            # Jobs abandoned by another process while this one is up
+            already_queued = set(self._queue.queue)
+            for job_id in self.store.claimable(include_queued=False):
+                if job_id not in already_queued and job_id not in running:
+                    self._enqueue(job_id)
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            with self._lock:
+                self._queued -= 1
+
+            # Another process may have taken the job in the meantime
+            if not self.store.claim(job_id, self.owner, self.lease_seconds):
+                continue
+            with self._lock:
+                self._running.add(job_id)
+            job = self.store.get(job_id)
+            stages = job["stages"]
+
+            def on_stage_done(name, _):
+                stages[name] = "done"
+                self.store.update(job_id, stages=stages)
+
+            try:
+                result = self.run_job(job, on_stage_done)
+                self.store.update(job_id, status="done", result=result)
+            except Exception as e:
+                traceback.print_exc()
+                self.store.update(job_id, status="failed", error=str(e))
+            finally:
+                with self._lock:
+                    self._running.discard(job_id)
@@ -0,0 +1,298 @@
+import contextvars
+import os
+import subprocess
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+
+from audio import SAMPLE_RATE, transcribe
+from rate_limits import INTERACTIVE, llm_priority
+
+# Audio of a live session is transcribed again every LIVE_STEP_SECONDS of new audio, from
+# the end of the last final segment. All segments but the last one of such a pass are final,
+# the last one too once the window reaches LIVE_WINDOW_SECONDS.
+LIVE_STEP_SECONDS = float(os.environ.get('LIVE_STEP_SECONDS', 3))
+LIVE_WINDOW_SECONDS = float(os.environ.get('LIVE_WINDOW_SECONDS', 30))
+LIVE_MAX_SESSIONS = int(os.environ.get('LIVE_MAX_SESSIONS', 10))
+# Finished sessions and their events are dropped after this many seconds
+LIVE_SESSION_TTL = float(os.environ.get('LIVE_SESSION_TTL', 3600))
+# A session that gets no audio for this many seconds is ended as if the client had ended it
+LIVE_IDLE_SECONDS = float(os.environ.get('LIVE_IDLE_SECONDS', 60))
+LIVE_ANALYSIS_WORKERS = int(os.environ.get('LIVE_ANALYSIS_WORKERS', 8))
+
+# Raw PCM formats that are read directly, anything else is decoded by ffmpeg
+PCM_FORMATS = {"s16le": np.int16, "f32le": np.float32}
+
+_analysis_executor = ThreadPoolExecutor(max_workers=LIVE_ANALYSIS_WORKERS)
+
+
+class TooManySessions(Exception):
+    pass
+
+
+class StreamEnded(Exception):
+    pass
+
+
+class LiveSession:
+    # One live stream: audio chunks come in through write(), final segments are analyzed as
+    # soon as they're transcribed and everything is published as numbered events
+    def __init__(self, session_id, input_format="auto"):
+        self.id = session_id
+        self.input_format = input_format
+        self.created_at = time.time()
+        self.finished_at = None
+        self.ended = False
+        self.timed_out = False
+        self.last_write_at = time.time()
+
+        self._condition = threading.Condition()
+        self._events = []
+        # Audio after the last final segment, and the time in the stream where it starts
+        self._audio = bytearray()
+        self._audio_start = 0.0
+        self._received_samples = 0
+        self._decoded_samples = 0
+        self._audio_complete = False
+        self._remainder = b""
+
+        self.segments = []
+        self._analyses = {}
+        self._comparisons = {}
+        self._futures = []
+
+        self._decoder = None
+        if input_format not in PCM_FORMATS:
+            command = ["ffmpeg", "-nostdin", "-loglevel", "error"]
+            if input_format != "auto":
+                command += ["-f", input_format]
+            command += ["-i", "pipe:0", "-vn", "-f", "f32le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1"]
+            self._decoder = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                             stderr=subprocess.DEVNULL)
+            threading.Thread(target=self._read_decoder, daemon=True).start()
+
+        threading.Thread(target=contextvars.copy_context().run, args=(self._run,), daemon=True).start()
+
+    @property
+    def received_seconds(self):
+        return self._received_samples / SAMPLE_RATE
+
+    @property
+    def last_event_id(self):
+        return len(self._events)
+
+    def publish(self, event, data):
+        with self._condition:
+            self._events.append((len(self._events) + 1, event, data))
+            self._condition.notify_all()
+
+    # Events with an id above after_id, waits up to timeout seconds for the first one
+    def events_after(self, after_id, timeout):
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._events) > after_id or self.finished_at is not None, timeout)
+            return self._events[after_id:]
+
+    def write(self, data):
+        if self.ended:
+            raise StreamEnded(f"Live session {self.id} has ended")
+        self.last_write_at = time.time()
+        if self._decoder is not None:
+            try:
+                self._decoder.stdin.write(data)
+                self._decoder.stdin.flush()
+            except (BrokenPipeError, ValueError):
+                # Ended by another request or the idle timeout while writing
+                raise StreamEnded(f"Live session {self.id} has ended")
+        else:
+            self._add_pcm(data)
+
+    def end(self):
+        if self.ended:
+            return
+        self.ended = True
+        if self._decoder is not None:
+            # The decoder flushes the rest of the audio and closes its output
+            self._decoder.stdin.close()
+        else:
+            with self._condition:
+                self._audio_complete = True
+                self._condition.notify_all()
+
+    def _add_pcm(self, data):
+        dtype = PCM_FORMATS.get(self.input_format, np.float32)
+        data = self._remainder + data
+        usable = len(data) - len(data) % np.dtype(dtype).itemsize
+        self._remainder = data[usable:]
+        samples = np.frombuffer(data[:usable], dtype=dtype)
+        if dtype == np.int16:
+            samples = samples.astype(np.float32) / 32768
+
+        with self._condition:
+            self._audio.extend(samples.astype(np.float32).tobytes())
+            self._received_samples += len(samples)
+            self._condition.notify_all()
+
+    def _read_decoder(self):
+        while True:
+            data = self._decoder.stdout.read(64 * 1024)
+            if not data:
+                break
+            self._add_pcm(data)
+        self._decoder.wait()
+        with self._condition:
+            self._audio_complete = True
+            self._condition.notify_all()
+
+    def _run(self):
+        try:
+            while True:
+                with self._condition:
+                    ready = self._condition.wait_for(lambda: self._audio_complete or (
+                        self._received_samples - self._decoded_samples >= LIVE_STEP_SECONDS * SAMPLE_RATE),
+                        LIVE_IDLE_SECONDS)
+                    if ready:
+                        complete = self._audio_complete
+                        audio = np.frombuffer(bytes(self._audio), dtype=np.float32)
+                        audio_start = self._audio_start
+                        self._decoded_samples = self._received_samples
+                if not ready:
+                    # The client went away without ending the stream
+                    if not self.ended and time.time() - self.last_write_at >= LIVE_IDLE_SECONDS:
+                        self.timed_out = True
+                        self.end()
+                    continue
+
+                if len(audio):
+                    try:
+                        # Live sessions have their own model, uploads don't hold them up
+                        _, segments = transcribe(audio, workers=0, raise_errors=True, lane="live")
+                    except Exception as e:
+                        # The audio is kept and transcribed again with the next step
+                        traceback.print_exc()
+                        self.publish("error", {'error': 'An error occurred during live transcription.',
+                                               'reason': str(e)})
+                        if complete:
+                            break
+                        continue
+                    window_full = len(audio) >= LIVE_WINDOW_SECONDS * SAMPLE_RATE
+                    if not complete and not window_full:
+                        segments = segments[:-1]
+                    if segments:
+                        self._commit(segments, audio_start)
+                        self._drop_audio(audio_start, segments[-1]["to"])
+                    elif window_full:
+                        # Nothing was said, only the last step is kept in case a word starts there
+                        self._drop_audio(audio_start, len(audio) / SAMPLE_RATE - LIVE_STEP_SECONDS)
+                if complete:
+                    break
+
+            self._finish()
+        except Exception as e:
+            traceback.print_exc()
+            self.publish("error", {'error': 'An error occurred during live analysis.', 'reason': str(e)})
+        finally:
+            with self._condition:
+                self.finished_at = time.time()
+                self.publish("end", {"session_id": self.id, "timed_out": self.timed_out})
+
+    # Publishes final segments and starts their analysis
+    def _commit(self, segments, audio_start):
+        for segment in segments:
+            if not segment["text"]:
+                continue
+            segment = {"text": segment["text"], "from": segment["from"] + audio_start, "to": segment["to"] + audio_start}
+            index = len(self.segments)
+            self.segments.append(segment)
+            self.publish("segment", {"index": index, **segment})
+            previous = self.segments[index - 1] if index > 0 else None
+            self._futures.append(_analysis_executor.submit(
+                contextvars.copy_context().run, self._analyze, index, segment, previous))
+
+    # Forgets the audio up to `seconds` after audio_start, it's never transcribed again
+    def _drop_audio(self, audio_start, seconds):
+        with self._condition:
+            drop = min(max(int(seconds * SAMPLE_RATE), 0) * 4, len(self._audio))
+            del self._audio[:drop]
+            self._audio_start = audio_start + drop / 4 / SAMPLE_RATE
+
+    def _analyze(self, index, segment, previous):
+        from pipeline import segment_analysis_json
+        from transcript_analysis_models import EventAnalysis, analyze_segment, analyze_segments_comparatively
+
+        # Feedback for a speaker who is waiting goes ahead of bulk video processing
+        with llm_priority(INTERACTIVE):
+            try:
+                analysis = analyze_segment(segment["text"])
+            except Exception as e:
+                analysis = e
+            self._analyses[index] = analysis
+            self.publish("segment_analysis", {"index": index, "analysis": segment_analysis_json(analysis)})
+
+            if previous is not None:
+                try:
+                    event = EventAnalysis(index=index, from_segment=index - 1, to_segment=index,
+                                          event_analysis=analyze_segments_comparatively(previous, segment))
+                except Exception as e:
+                    event = EventAnalysis(index=index, from_segment=index - 1, to_segment=index, error=str(e))
+                self._comparisons[index] = event
+                self.publish("event", event.dict())
+
+    # Whole-transcript stages over everything that was said, once the stream has ended
+    def _finish(self):
+        from ask_questions import ask_questions
+        from pipeline import STAGE_EVENTS, Stage, run_stages, segment_analysis_json
+        from summary import write_summary
+        from transcript_analysis_models import analyze_transcription
+
+        wait(self._futures)
+        transcription = " ".join(segment["text"] for segment in self.segments)
+        results = {}
+        if self.segments:
+            with llm_priority(INTERACTIVE):
+                results = run_stages([
+                    Stage("quality_metrics", lambda: analyze_transcription(self.segments)),
+                    Stage("summary", lambda: write_summary(transcription)),
+                    Stage("questions", lambda: ask_questions(transcription)),
+                ], on_stage_done=lambda name, result: self.publish(name, STAGE_EVENTS[name](result)))
+
+        self.publish("result", {
+            "session_id": self.id,
+            "duration": self.received_seconds,
+            "transcription": self.segments,
+            "segments_analysis": [segment_analysis_json(self._analyses[index]) for index in range(len(self.segments))],
+            "events": [self._comparisons[index].dict() for index in sorted(self._comparisons)],
+            **{key: value for name, result in results.items() for key, value in STAGE_EVENTS[name](result).items()},
+        })
+
+
+class LiveSessions:
+    def __init__(self, max_sessions=LIVE_MAX_SESSIONS, ttl_seconds=LIVE_SESSION_TTL):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def create(self, input_format="auto"):
+        with self._lock:
+            now = time.time()
+            for session_id, session in list(self._sessions.items()):
+                if session.finished_at is not None and session.finished_at + self.ttl_seconds < now:
+                    del self._sessions[session_id]
+            running = sum(session.finished_at is None for session in self._sessions.values())
+            if running >= self.max_sessions:
+                raise TooManySessions(f"{running} live sessions are already running")
+
+            session = LiveSession(str(uuid.uuid4()), input_format)
+            self._sessions[session.id] = session
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            return self._sessions.get(session_id)
+
+
+live_sessions = LiveSessions()
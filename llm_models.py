@@ -1,15 +1,95 @@
 import os
-from langchain_community.chat_models import ChatOpenAI, ChatCohere
-from langchain.llms import Cohere
-from langchain_community.embeddings import OpenAIEmbeddings
-from langchain_core.prompts import PromptTemplate
+from functools import lru_cache
+
+import fake_backends
 
 openai_api_key = os.environ.get('OPENAI_API_KEY')
 cohere_api_key = os.environ.get('COHERE_API_KEY')
 
-open_ai_llm = ChatOpenAI(model="gpt-4o", temperature=0.0, api_key=openai_api_key)
-command_r_plus_llm = Cohere(model="command-r-plus", temperature=0.0, cohere_api_key=cohere_api_key)
 
-open_ai_llm_mini = ChatOpenAI(model="gpt-4o-mini", temperature=0.0, api_key=openai_api_key)
-embeddings = OpenAIEmbeddings(openai_api_key=openai_api_key)
+@lru_cache(maxsize=None)
+def response_cache():
+    from langchain_core.globals import set_llm_cache
+
+    from response_cache import create_response_cache
+
+    # Every chat model and LLM below answers identical prompts from this cache
+    cache = create_response_cache()
+    set_llm_cache(cache)
+    return cache
+
+
+# prompt | model | parser as one runnable. LangChain caches the model's answer before it is
+# parsed, so an answer the parser rejects, or that check(inputs, result) rejects by raising
+# OutputParserException, is removed from the response cache again. Retries then ask the
+# model instead of failing on the same cached answer.
+def checked_chain(prompt_template, model, parser, check=None):
+    from langchain_core.exceptions import OutputParserException
+    from langchain_core.runnables import RunnableLambda
+
+    def run(inputs):
+        message = (prompt_template | model).invoke(inputs)
+        try:
+            result = parser.invoke(message)
+            if check is not None:
+                check(inputs, result)
+            return result
+        except OutputParserException:
+            cache = response_cache()
+            if cache is not None:
+                cache.forget(getattr(message, "content", message))
+            raise
+
+    return RunnableLambda(run)
+
+
+# Requests of all models below are paced by rate_limits.llm_scheduler
+@lru_cache(maxsize=None)
+def open_ai_llm():
+    response_cache()
+    if fake_backends.enabled("llm"):
+        from fake_models import FakeChatModel
+
+        return FakeChatModel(provider="openai", model_name="gpt-4o")
+
+    from rate_limited_models import RateLimitedChatOpenAI
+
+    return RateLimitedChatOpenAI(model="gpt-4o", temperature=0.0, api_key=openai_api_key, max_retries=0)
+
+
+@lru_cache(maxsize=None)
+def command_r_plus_llm():
+    response_cache()
+    if fake_backends.enabled("llm"):
+        from fake_models import FakeChatModel
+
+        return FakeChatModel(provider="cohere", model_name="command-r-plus")
+
+    from rate_limited_models import RateLimitedCohere
+
+    return RateLimitedCohere(model="command-r-plus", temperature=0.0, cohere_api_key=cohere_api_key, max_retries=1)
+
+
+@lru_cache(maxsize=None)
+def open_ai_llm_mini():
+    response_cache()
+    if fake_backends.enabled("llm"):
+        from fake_models import FakeChatModel
+
+        return FakeChatModel(provider="openai", model_name="gpt-4o-mini")
+
+    from rate_limited_models import RateLimitedChatOpenAI
+
+    return RateLimitedChatOpenAI(model="gpt-4o-mini", temperature=0.0, api_key=openai_api_key, max_retries=0)
+
+
+@lru_cache(maxsize=None)
+def embeddings():
+    if fake_backends.enabled("llm"):
+        from fake_models import FakeEmbeddings
+
+        return FakeEmbeddings()
+
+    from rate_limited_models import RateLimitedOpenAIEmbeddings
 
+    return RateLimitedOpenAIEmbeddings(openai_api_key=openai_api_key, max_retries=0)
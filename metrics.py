@@ -0,0 +1,219 @@
+import bisect
+import contextvars
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # Per label values: count per bucket (the last one is +Inf), sum
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                    cumulative += count
+                    labels = _format_labels(self.labelnames, key, [("le", bound)])
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    # Value read from func() when the metrics are scraped
+    def __init__(self, name, documentation, func):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+
+    def render(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge", f"{self.name} {self.func()}"]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    # Prometheus text exposition format
+    def render(self):
+        return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
+
+
+registry = MetricsRegistry()
+
+stage_seconds = registry.register(Histogram(
+    "pipeline_stage_seconds", "Wall time of pipeline stages", ["stage"]))
+stage_queue_seconds = registry.register(Histogram(
+    "pipeline_stage_queue_seconds", "Time pipeline stages waited for a worker once their inputs were ready", ["stage"]))
+stage_errors = registry.register(Counter(
+    "pipeline_stage_errors_total", "Pipeline stages that raised an exception", ["stage"]))
+llm_request_seconds = registry.register(Histogram(
+    "llm_request_seconds", "Wall time of LLM and embedding requests sent to the provider", ["stage", "model"]))
+llm_wait_seconds = registry.register(Histogram(
+    "llm_rate_limit_wait_seconds", "Time LLM and embedding requests waited for the rate limiter", ["stage", "model"]))
+llm_tokens = registry.register(Counter(
+    "llm_tokens_total", "Prompt and completion tokens, estimated when the provider doesn't report them",
+    ["stage", "model", "kind"]))
+llm_errors = registry.register(Counter(
+    "llm_errors_total", "LLM and embedding requests that failed", ["stage", "model"]))
+llm_retries = registry.register(Counter(
+    "llm_retries_total", "LLM and embedding requests retried after a rate limit error", ["stage", "model"]))
+cache_lookups = registry.register(Counter(
+    "cache_lookups_total", "Lookups in the LLM response and embedding caches", ["cache", "stage", "model", "result"]))
+
+
+class RequestTimings:
+    # Everything observed while handling one request, see collect_timings
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self.stages = {}
+        self.models = defaultdict(lambda: {"requests": 0, "seconds": 0.0, "wait_seconds": 0.0, "prompt_tokens": 0,
+                                           "completion_tokens": 0, "errors": 0, "cache_hits": 0, "cache_misses": 0})
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "total_seconds": time.perf_counter() - self.started,
+                "stages": {name: dict(stage) for name, stage in self.stages.items()},
+                "models": {name: dict(model) for name, model in self.models.items()},
+            }
+
+
+_stage = contextvars.ContextVar("pipeline_stage", default="none")
+_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+@contextmanager
+def stage_context(name):
+    token = _stage.set(name)
+    try:
+        yield
+    finally:
+        _stage.reset(token)
+
+
+def current_stage():
+    return _stage.get()
+
+
+# Stages and model requests run inside this block, including those on other threads that
+# got a copy of the context, are added to the yielded RequestTimings
+@contextmanager
+def collect_timings():
+    timings = RequestTimings()
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+def observe_stage(name, queue_seconds, seconds, error=False):
+    stage_seconds.observe(seconds, stage=name)
+    stage_queue_seconds.observe(queue_seconds, stage=name)
+    if error:
+        stage_errors.inc(stage=name)
+
+    timings = _timings.get()
+    if timings is not None:
+        with timings._lock:
+            timings.stages[name] = {"seconds": seconds, "queue_seconds": queue_seconds, "error": error}
+
+
+def observe_llm_request(model, seconds, prompt_tokens, completion_tokens, error=False):
+    stage = current_stage()
+    llm_request_seconds.observe(seconds, stage=stage, model=model)
+    llm_tokens.inc(prompt_tokens, stage=stage, model=model, kind="prompt")
+    llm_tokens.inc(completion_tokens, stage=stage, model=model, kind="completion")
+    if error:
+        llm_errors.inc(stage=stage, model=model)
+
+    timings = _timings.get()
+    if timings is not None:
+        with timings._lock:
+            stats = timings.models[model]
+            stats["requests"] += 1
+            stats["seconds"] += seconds
+            stats["prompt_tokens"] += prompt_tokens
+            stats["completion_tokens"] += completion_tokens
+            stats["errors"] += int(error)
+
+
+def observe_llm_wait(model, seconds, retry=False):
+    stage = current_stage()
+    llm_wait_seconds.observe(seconds, stage=stage, model=model)
+    if retry:
+        llm_retries.inc(stage=stage, model=model)
+
+    timings = _timings.get()
+    if timings is not None:
+        with timings._lock:
+            timings.models[model]["wait_seconds"] += seconds
+
+
+def observe_cache_lookups(cache, model, hits, misses):
+    stage = current_stage()
+    if hits:
+        cache_lookups.inc(hits, cache=cache, stage=stage, model=model, result="hit")
+    if misses:
+        cache_lookups.inc(misses, cache=cache, stage=stage, model=model, result="miss")
+
+    timings = _timings.get()
+    if timings is not None:
+        with timings._lock:
+            timings.models[model]["cache_hits"] += hits
+            timings.models[model]["cache_misses"] += misses
@@ -0,0 +1,52 @@
+import os
+import shutil
+from functools import lru_cache
+
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class GCSObjectStore:
+    # Uploads files to a Cloud Storage bucket with resumable uploads of UPLOAD_CHUNK_SIZE chunks,
+    # so the file is never held in memory as a whole
+    def __init__(self, bucket_name, prefix="videos"):
+        from google.cloud import storage
+
+        self.bucket = storage.Client().bucket(bucket_name)
+        self.prefix = prefix
+
+    def upload(self, path, name=None):
+        blob = self.bucket.blob(f"{self.prefix}/{name or os.path.basename(path)}", chunk_size=UPLOAD_CHUNK_SIZE)
+        # Uploads are content addressed, an existing object already has the same content
+        if not blob.exists():
+            blob.upload_from_filename(path)
+        return f"gs://{self.bucket.name}/{blob.name}"
+
+
+class LocalObjectStore:
+    # Stand-in for a bucket when working offline, files are copied in chunks to a local folder
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def upload(self, path, name=None):
+        target = os.path.abspath(os.path.join(self.folder, name or os.path.basename(path)))
+        if not os.path.exists(target):
+            with open(path, "rb") as source, open(target + ".part", "wb") as destination:
+                shutil.copyfileobj(source, destination, UPLOAD_CHUNK_SIZE)
+            os.replace(target + ".part", target)
+        return f"file://{target}"
+
+
+# Created on first use: the Cloud Storage client looks up credentials, which can need the network
+@lru_cache(maxsize=None)
+def object_store():
+    return create_object_store()
+
+
+def create_object_store():
+    if os.environ.get('VIDEO_STORAGE_BUCKET'):
+        return GCSObjectStore(os.environ['VIDEO_STORAGE_BUCKET'])
+    if os.environ.get('VIDEO_STORAGE_DIR'):
+        return LocalObjectStore(os.environ['VIDEO_STORAGE_DIR'])
+    return None
+
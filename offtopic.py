@@ -1,37 +1,43 @@
-from sklearn.metrics.pairwise import cosine_similarity
+import os
+
+import numpy as np
 
 from transcript_analysis_models import OffTopicSegment
-from util import segment_transcript, extract_main_subject
-from embeddings import get_embeddings
+from util import extract_main_subject
+from embeddings import get_embeddings_batch
+
+OFF_TOPIC_THRESHOLD = float(os.environ.get('OFF_TOPIC_THRESHOLD', 0.7))
 
 
-def find_off_topic_sentences(main_subject, sentences):
-    main_embedding = get_embeddings(main_subject)
-    off_topic_sentences = []
+def find_off_topic_sentences(main_subject, sentences, threshold=OFF_TOPIC_THRESHOLD):
+    if not sentences:
+        return []
 
-    for sentence in sentences:
-        sentence_embedding = get_embeddings(sentence)
-        similarity = cosine_similarity(
-            [main_embedding],
-            [sentence_embedding]
-        )[0][0]
-        if similarity < 0.7:  # Threshold can be adjusted
-            off_topic_sentences.append({'text': sentence, 'similarity': similarity})
+    # Embed the main subject together with all sentences in as few requests as possible
+    vectors = np.asarray(get_embeddings_batch([main_subject] + list(sentences)), dtype=np.float32)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    similarities = vectors[1:] @ vectors[0]
 
-    return off_topic_sentences
+    return [
+        {'index': int(index), 'text': sentences[index], 'similarity': float(similarities[index])}
+        for index in np.flatnonzero(similarities < threshold)
+    ]
 
 
-def detect_off_topic_using_embeddings(transcription):
+# Compares every transcript segment with the main subject, so segment_index of the result
+# points into the segments returned with the transcription
+def detect_off_topic_using_embeddings(transcription, segments, threshold=OFF_TOPIC_THRESHOLD):
     main_subject = extract_main_subject(transcription)
-    sentences = segment_transcript(transcription)
-    off_topic_sentences_data = find_off_topic_sentences(main_subject, sentences)
+    # Segments without words aren't embedded
+    indexed = [(index, segment["text"]) for index, segment in enumerate(segments) if segment["text"].strip()]
+    off_topic_sentences_data = find_off_topic_sentences(main_subject, [text for _, text in indexed], threshold)
 
     off_topic_segments = []
     for item in off_topic_sentences_data:
         text = item['text']
         similarity = item['similarity']
-        reason = f"Similarity score {similarity:.2f} is below the threshold, indicating the sentence may not be related to the main subject."
-        segment = OffTopicSegment(text=text, reason=reason)
+        reason = f"Similarity score {similarity:.2f} is below the threshold, indicating the segment may not be related to the main subject."
+        segment = OffTopicSegment(text=text, reason=reason, segment_index=indexed[item['index']][0])
         off_topic_segments.append(segment)
 
     return main_subject, off_topic_segments
@@ -0,0 +1,118 @@
+import io
+import os
+
+import numpy as np
+
+# Person bounding boxes are kept column by column: one array per field with one entry per box,
+# boxes of a track are consecutive and ordered by time
+COLUMNS = ["track_id", "time_offset", "left", "top", "right", "bottom"]
+BOX_COLUMNS = COLUMNS[1:]
+
+PERSONS_SAMPLE_INTERVAL = float(os.environ.get('PERSONS_SAMPLE_INTERVAL', 0))
+PERSONS_KEYFRAMES_ONLY = os.environ.get('PERSONS_KEYFRAMES_ONLY', '0') == '1'
+PERSONS_KEYFRAME_DELTA = float(os.environ.get('PERSONS_KEYFRAME_DELTA', 0.05))
+
+
+DTYPES = {"track_id": np.int32, "time_offset": np.float64, "left": np.float32, "top": np.float32,
+          "right": np.float32, "bottom": np.float32}
+# float32 coordinates are written with this many decimals, which is below their precision
+JSON_DECIMALS = 5
+
+
+def empty_columns():
+    return {name: np.empty(0, dtype=DTYPES[name]) for name in COLUMNS}
+
+
+def columns_from_annotations(person_detection_annotations):
+    rows = {name: [] for name in COLUMNS}
+    track_id = 0
+    for person_annotation in person_detection_annotations:
+        for track in person_annotation.tracks:
+            for timestamped_object in track.timestamped_objects:
+                box = timestamped_object.normalized_bounding_box
+                rows["track_id"].append(track_id)
+                rows["time_offset"].append(timestamped_object.time_offset.seconds + timestamped_object.time_offset.microseconds * 1e-6)
+                rows["left"].append(box.left)
+                rows["top"].append(box.top)
+                rows["right"].append(box.right)
+                rows["bottom"].append(box.bottom)
+            track_id += 1
+
+    if not rows["track_id"]:
+        return empty_columns()
+    columns = {name: np.asarray(values, dtype=DTYPES[name]) for name, values in rows.items()}
+    return select(columns, np.lexsort((columns["time_offset"], columns["track_id"])))
+
+
+def select(columns, indexes):
+    return {name: values[indexes] for name, values in columns.items()}
+
+
+# Keeps the first box of every track in every `interval` seconds
+def downsample(columns, interval):
+    if interval <= 0 or len(columns["track_id"]) == 0:
+        return columns
+    buckets = np.floor(columns["time_offset"] / interval).astype(np.int64)
+    _, first = np.unique(np.stack([columns["track_id"].astype(np.int64), buckets], axis=1), axis=0, return_index=True)
+    return select(columns, np.sort(first))
+
+
+# Keeps the first and last box of every track and the boxes that moved more than `delta`
+# (in normalized coordinates) from the last kept box of the track
+def keyframes(columns, delta):
+    track_ids = columns["track_id"]
+    boxes = np.stack([columns[name] for name in ["left", "top", "right", "bottom"]], axis=1)
+    kept = []
+    for index in range(len(track_ids)):
+        first = index == 0 or track_ids[index] != track_ids[index - 1]
+        last = index == len(track_ids) - 1 or track_ids[index] != track_ids[index + 1]
+        if first or last or np.abs(boxes[index] - boxes[kept[-1]]).max() > delta:
+            kept.append(index)
+    return select(columns, np.asarray(kept, dtype=np.int64))
+
+
+def reduce_columns(columns, sample_interval=PERSONS_SAMPLE_INTERVAL, keyframes_only=PERSONS_KEYFRAMES_ONLY,
+                   keyframe_delta=PERSONS_KEYFRAME_DELTA):
+    columns = downsample(columns, sample_interval)
+    if keyframes_only:
+        columns = keyframes(columns, keyframe_delta)
+    return columns
+
+
+def _json_values(columns, name):
+    values = columns[name]
+    if values.dtype == np.float32:
+        values = np.round(values.astype(np.float64), JSON_DECIMALS)
+    return values.tolist()
+
+
+def to_json(columns):
+    return {name: _json_values(columns, name) for name in COLUMNS}
+
+
+def from_json(data):
+    return {name: np.asarray(data[name], dtype=DTYPES[name]) for name in COLUMNS}
+
+
+# The list of {"time_offset", "left", "top", "right", "bottom"} dicts that used to be returned
+def to_list(columns):
+    values = [_json_values(columns, name) for name in BOX_COLUMNS]
+    return [dict(zip(BOX_COLUMNS, row)) for row in zip(*values)]
+
+
+# detected_persons of a response in the format asked for: "columnar" (default) or "list"
+def format_persons(data, persons_format="columnar"):
+    if persons_format == "list":
+        return to_list(from_json(data))
+    return data
+
+
+def to_npz(columns):
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **columns)
+    return buffer.getvalue()
+
+
+def from_npz(data):
+    with np.load(io.BytesIO(data)) as arrays:
+        return {name: arrays[name].astype(DTYPES[name]) for name in COLUMNS}
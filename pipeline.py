@@ -0,0 +1,171 @@
+import contextvars
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, List, Optional, Sequence
+
+from ask_questions import ask_questions
+from audio import extract_audio, transcribe, PERSIST_AUDIO
+from compare_subtitles import compare_subtitles
+from emotions import detect_emotions
+from metrics import observe_stage, stage_context
+import person_boxes
+from offtopic import detect_off_topic_using_embeddings
+from summary import write_summary
+from transcript_analysis_models import analyze_transcription, analyze_events, analyze_segments, AnalysisResult
+from video_ai import analyze_video
+
+
+class Stage:
+    def __init__(self, name: str, func: Callable, depends_on: Sequence[str] = ()):
+        self.name = name
+        self.func = func
+        self.depends_on = tuple(depends_on)
+
+
+# Runs one stage and records its wall time and how long it waited for a worker thread.
+# LLM requests made by the stage are labeled with its name.
+def _run_stage(stage: Stage, submitted_at: float, *args):
+    started = time.perf_counter()
+    error = False
+    try:
+        with stage_context(stage.name):
+            return stage.func(*args)
+    except Exception:
+        error = True
+        raise
+    finally:
+        observe_stage(stage.name, started - submitted_at, time.perf_counter() - started, error)
+
+
+# Runs every stage as soon as all of its dependencies have finished. The stage function
+# receives the results of its dependencies as positional arguments, in declared order,
+# and runs in a copy of the caller's context. on_stage_done(name, result) is called from
+# the calling thread after each stage finishes. Stages mostly wait for models and other
+# processes, by default every stage gets its own thread.
+def run_stages(stages: List[Stage], max_workers: Optional[int] = None, on_stage_done: Optional[Callable] = None):
+    pending = {stage.name: stage for stage in stages}
+    for stage in stages:
+        for dependency in stage.depends_on:
+            if dependency not in pending:
+                raise ValueError(f"Stage '{stage.name}' depends on unknown stage '{dependency}'")
+
+    results = {}
+    running = {}
+    executor = ThreadPoolExecutor(max_workers=max_workers or len(stages))
+    failed = True
+    try:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if all(dependency in results for dependency in stage.depends_on):
+                    args = [results[dependency] for dependency in stage.depends_on]
+                    future = executor.submit(contextvars.copy_context().run, _run_stage, stage, time.perf_counter(), *args)
+                    running[future] = name
+                    del pending[name]
+
+            if not running:
+                raise ValueError(f"Stages {sorted(pending)} have cyclic dependencies")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result()
+                if on_stage_done is not None:
+                    on_stage_done(name, results[name])
+        failed = False
+    finally:
+        # After a failure the error is returned without waiting for the stages still running
+        executor.shutdown(wait=not failed, cancel_futures=True)
+
+    return results
+
+
+# on_partial(event, data) receives results that are ready before their stage has finished:
+# a "segment_analysis" for every segment and an "event" for every pair of segments
+def video_stages(video_path: str, audio_path: Optional[str] = None,
+                 on_partial: Optional[Callable] = None) -> List[Stage]:
+    on_segment_analysis = on_event = None
+    if on_partial is not None:
+        on_segment_analysis = lambda index, result: on_partial(
+            "segment_analysis", {"index": index, "analysis": segment_analysis_json(result)})
+        on_event = lambda event: on_partial("event", event.dict())
+
+    return [
+        # Video-only stages start straight away, in parallel with audio extraction and Whisper
+        Stage("video", lambda: analyze_video(video_path)),
+        Stage("emotions", lambda: detect_emotions(video_path)),
+
+        Stage("audio", lambda: extract_audio(video_path, audio_path)),
+        # A failed transcription fails the request, there is nothing to analyze
+        Stage("transcription", lambda audio: transcribe(audio, raise_errors=True), depends_on=["audio"]),
+
+        Stage("off_topic", lambda t: detect_off_topic_using_embeddings(t[0], t[1]), depends_on=["transcription"]),
+        Stage("quality_metrics", lambda t: analyze_transcription(t[1]), depends_on=["transcription"]),
+        Stage("events", lambda t: analyze_events(t[1], on_result=on_event), depends_on=["transcription"]),
+        Stage("segments_analysis", lambda t: analyze_segments(t[1], on_result=on_segment_analysis),
+              depends_on=["transcription"]),
+        Stage("questions", lambda t: ask_questions(t[0]), depends_on=["transcription"]),
+        Stage("summary", lambda t: write_summary(t[0]), depends_on=["transcription"]),
+        Stage("subtitles_matching", lambda t, v: compare_subtitles(t[1], v[0]),
+              depends_on=["transcription", "video"]),
+    ]
+
+
+def segment_analysis_json(segment_analysis):
+    if isinstance(segment_analysis, Exception):
+        return {"error": str(segment_analysis)}
+    return segment_analysis.dict()
+
+
+# JSON form of the finished stages that are worth showing before the whole result, keyed by
+# stage name. The fields have the same names as in the assembled result.
+STAGE_EVENTS = {
+    "transcription": lambda result: {"transcription": result[1]},
+    "video": lambda result: {"subtitles": result[0]},
+    "emotions": lambda result: {"emotions": result[0], "duration": result[1]},
+    "off_topic": lambda result: {"main_subject": result[0],
+                                 "off_topic_segments": [segment.dict() for segment in result[1]]},
+    "quality_metrics": lambda result: {"quality_metrics": result.dict()},
+    "subtitles_matching": lambda result: {"subtitles_matching": result.dict()},
+    "questions": lambda result: {"questions": result.dict()["questions"]},
+    "summary": lambda result: {"summary": result.dict()["summary"]},
+}
+
+
+# Whether every item of an assembled result was analyzed. Results with errors of single
+# segments or events are returned but not stored, the next upload analyzes them again.
+def is_complete(result):
+    return not any(item.get("error") for item in result["segments_analysis"] + result["events"])
+
+
+def assemble_result(results):
+    transcription, segments = results["transcription"]
+    main_subject, off_topic_segments = results["off_topic"]
+    detected_subtitles, bounding_boxes = results["video"]
+    emotions, duration = results["emotions"]
+
+    analysis = AnalysisResult(
+        main_subject=main_subject,
+        off_topic_segments=off_topic_segments,
+        quality_metrics=results["quality_metrics"]
+    )
+
+    return {
+        'duration': duration,
+        'transcription': segments,
+        'analysis': analysis.dict(),
+        "segments_analysis": [segment_analysis_json(segment_analysis) for segment_analysis in results["segments_analysis"]],
+        "events": [event.dict() for event in results["events"]],
+        "subtitles_matching": results["subtitles_matching"].dict(),
+        "emotions": emotions,
+        "questions": results["questions"].dict()["questions"],
+        "summary": results["summary"].dict()["summary"],
+        "detected_persons": person_boxes.to_json(bounding_boxes),
+    }
+
+
+def process_video_file(video_path: str, max_workers: Optional[int] = None, on_stage_done: Optional[Callable] = None,
+                       persist_audio: bool = PERSIST_AUDIO, on_partial: Optional[Callable] = None):
+    audio_path = os.path.splitext(video_path)[0] + '.wav' if persist_audio else None
+    results = run_stages(video_stages(video_path, audio_path, on_partial), max_workers, on_stage_done)
+    return assemble_result(results)
@@ -0,0 +1,49 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+class SpawnedPool:
+    # Process pool created on first use. Workers are spawned so they don't inherit the
+    # server's threads and loaded models. The pool is replaced when it's asked for with other
+    # settings, and when one of its workers dies (e.g. killed for running out of memory), as
+    # a ProcessPoolExecutor stays broken after that.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._settings = None
+
+    def _get(self, workers, initializer, initargs):
+        with self._lock:
+            if self._executor is not None and self._settings != (workers, initializer, initargs):
+                # Work already submitted to the old pool still finishes
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                    initializer=initializer, initargs=initargs
+                )
+                self._settings = (workers, initializer, initargs)
+            return self._executor
+
+    def _discard(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    # Runs every (func, *args) call in the pool and returns their results in order. When a
+    # worker dies the calls are run once more on a new pool, BrokenProcessPool is raised if
+    # that fails too.
+    def run(self, calls, workers, initializer=None, initargs=()):
+        for attempt in range(2):
+            executor = self._get(workers, initializer, initargs)
+            try:
+                futures = [executor.submit(func, *args) for func, *args in calls]
+                return [future.result() for future in futures]
+            except BrokenProcessPool:
+                self._discard(executor)
+                if attempt == 1:
+                    raise
@@ -0,0 +1,50 @@
+import argparse
+import re
+import subprocess
+import sys
+import time
+
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+# Imports a module in a fresh interpreter with -X importtime and reports the slowest imports
+def profile_imports(module):
+    started = time.perf_counter()
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                             capture_output=True, text=True)
+    wall_seconds = time.perf_counter() - started
+
+    imports = []
+    for line in process.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            imports.append({
+                "module": match.group(4),
+                "self_ms": int(match.group(1)) / 1000,
+                "cumulative_ms": int(match.group(2)) / 1000,
+                "depth": len(match.group(3)) // 2,
+            })
+
+    if process.returncode != 0:
+        print(process.stderr.splitlines()[-1] if process.stderr else "Import failed", file=sys.stderr)
+    return wall_seconds, imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the import time of the application")
+    parser.add_argument("module", nargs="?", default="app")
+    parser.add_argument("--top", type=int, default=25)
+    args = parser.parse_args()
+
+    wall_seconds, imports = profile_imports(args.module)
+    top_level = [entry for entry in imports if entry["depth"] == 0]
+
+    print(f"Interpreter start and 'import {args.module}': {wall_seconds:.3f} s")
+    print(f"Time in imports: {sum(entry['cumulative_ms'] for entry in top_level):.1f} ms\n")
+    print(f"{'cumulative ms':>14} {'self ms':>10}  module")
+    for entry in sorted(imports, key=lambda entry: entry["cumulative_ms"], reverse=True)[:args.top]:
+        print(f"{entry['cumulative_ms']:>14.1f} {entry['self_ms']:>10.1f}  {entry['module']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import time
+from typing import ClassVar
+
+from langchain_community.chat_models import ChatOpenAI
+from langchain_community.embeddings import OpenAIEmbeddings
+from langchain_community.llms import Cohere
+
+from metrics import observe_llm_request
+from rate_limits import LLM_COMPLETION_TOKENS, estimate_tokens, llm_scheduler
+
+# Sends the request through llm_scheduler and records its time, tokens and errors. The
+# models below only call it from _generate, so answers from the response cache don't use
+# any of the quota. The clients' own retries are turned off in llm_models, the scheduler
+# retries instead. usage(result) returns (prompt_tokens, completion_tokens), or None when
+# they're unknown.
+def scheduled_request(provider, model, prompt_tokens, call, usage):
+    started = time.perf_counter()
+    try:
+        result = llm_scheduler.run(provider, model, prompt_tokens + LLM_COMPLETION_TOKENS, call)
+    except Exception:
+        observe_llm_request(model, time.perf_counter() - started, prompt_tokens, 0, error=True)
+        raise
+
+    tokens = usage(result)
+    if tokens is not None:
+        llm_scheduler.settle(provider, model, prompt_tokens + LLM_COMPLETION_TOKENS, sum(tokens))
+    prompt_tokens, completion_tokens = tokens or (prompt_tokens, 0)
+    observe_llm_request(model, time.perf_counter() - started, prompt_tokens, completion_tokens)
+    return result
+
+
+class RateLimitedChatOpenAI(ChatOpenAI):
+    provider: ClassVar[str] = "openai"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        def usage(result):
+            token_usage = (result.llm_output or {}).get("token_usage") or {}
+            if "prompt_tokens" not in token_usage:
+                return None
+            return token_usage["prompt_tokens"], token_usage.get("completion_tokens", 0)
+
+        return scheduled_request(
+            self.provider, self.model_name, sum(estimate_tokens(str(message.content)) for message in messages),
+            lambda: super(RateLimitedChatOpenAI, self)._generate(messages, stop, run_manager, **kwargs),
+            usage
+        )
+
+
+class RateLimitedCohere(Cohere):
+    provider: ClassVar[str] = "cohere"
+
+    def _generate(self, prompts, stop=None, run_manager=None, **kwargs):
+        prompt_tokens = sum(estimate_tokens(prompt) for prompt in prompts)
+
+        # Cohere doesn't report usage here, the answers are estimated like the prompts
+        def usage(result):
+            return prompt_tokens, sum(estimate_tokens(generation.text)
+                                      for generations in result.generations for generation in generations)
+
+        return scheduled_request(
+            self.provider, self.model, prompt_tokens,
+            lambda: super(RateLimitedCohere, self)._generate(prompts, stop, run_manager, **kwargs),
+            usage
+        )
+
+
+class RateLimitedOpenAIEmbeddings(OpenAIEmbeddings):
+    provider: ClassVar[str] = "openai"
+
+    def embed_documents(self, texts, chunk_size=0):
+        prompt_tokens = sum(estimate_tokens(text) for text in texts)
+        return scheduled_request(
+            self.provider, self.model, prompt_tokens,
+            lambda: super(RateLimitedOpenAIEmbeddings, self).embed_documents(texts, chunk_size),
+            lambda result: (prompt_tokens, 0)
+        )
@@ -0,0 +1,181 @@
+import contextvars
+import heapq
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from metrics import observe_llm_wait
+
+INTERACTIVE = 0
+BULK = 1
+
+# Requests and tokens per minute as a JSON object, e.g. {"openai:gpt-4o": {"rpm": 5000,
+# "tpm": 800000}}. "provider" limits are shared by all models of the provider,
+# "provider:model" limits apply to one model. Quotas depend on the account's usage tier, so
+# nothing is limited by default: requests are only slowed down by the retries after a 429.
+LLM_RATE_LIMITS = json.loads(os.environ.get('LLM_RATE_LIMITS', '{}'))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 6))
+# Tokens reserved for the answer of a request, settled with the real usage when it's known
+LLM_COMPLETION_TOKENS = int(os.environ.get('LLM_COMPLETION_TOKENS', 500))
+
+
+class TokenBucket:
+    # Holds up to `per_minute` units and refills continuously at per_minute / 60 per second.
+    # Taking more than is available leaves a debt that delays the next requests.
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.available = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until `amount` can be taken, amounts above the capacity wait for a full bucket
+    def wait_time(self, amount):
+        self._refill()
+        needed = min(amount, self.capacity)
+        return 0.0 if self.available >= needed else (needed - self.available) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.available -= amount
+
+    def drain(self):
+        self._refill()
+        self.available = min(self.available, 0.0)
+
+
+# About four characters per token for English text, close enough to budget requests
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+def is_rate_limit_error(error):
+    status_code = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    name = type(error).__name__
+    return status_code == 429 or "RateLimit" in name or "TooManyRequests" in name
+
+
+class LLMScheduler:
+    # Paces calls to every model under its requests/tokens per minute limits and those of
+    # its provider. Calls waiting for the same model are served by priority, interactive
+    # before bulk, then in arrival order, so a burst of pipeline work can't starve a user.
+    def __init__(self, limits, max_retries=LLM_MAX_RETRIES, backoff=1.0, max_backoff=60.0):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._limits = limits
+        self._buckets = {}
+        self._waiting = {}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stats = {}
+
+    def _buckets_for(self, provider, model):
+        buckets = []
+        for key in [provider, f"{provider}:{model}"]:
+            for unit, per_minute in self._limits.get(key, {}).items():
+                if (key, unit) not in self._buckets:
+                    self._buckets[(key, unit)] = TokenBucket(per_minute)
+                buckets.append((unit, self._buckets[(key, unit)]))
+        return buckets
+
+    # Blocks until the request may be sent, returns the seconds it waited
+    def acquire(self, provider, model, tokens, priority=BULK):
+        key = f"{provider}:{model}"
+        entry = (priority, next(self._sequence))
+        with self._condition:
+            buckets = self._buckets_for(provider, model)
+            waiting = self._waiting.setdefault(key, [])
+            heapq.heappush(waiting, entry)
+            started = time.monotonic()
+            try:
+                while True:
+                    timeout = None
+                    if waiting[0] == entry:
+                        timeout = max([bucket.wait_time(1 if unit == "rpm" else tokens) for unit, bucket in buckets],
+                                      default=0.0)
+                        if timeout == 0:
+                            for unit, bucket in buckets:
+                                bucket.take(1 if unit == "rpm" else tokens)
+                            break
+                    self._condition.wait(timeout)
+            finally:
+                waiting.remove(entry)
+                heapq.heapify(waiting)
+                self._condition.notify_all()
+
+            waited = time.monotonic() - started
+            stats = self._stats.setdefault(key, {"requests": 0, "tokens": 0, "wait_seconds": 0.0, "retries": 0})
+            stats["requests"] += 1
+            stats["tokens"] += tokens
+            stats["wait_seconds"] += waited
+        return waited
+
+    # Corrects the token buckets once the real usage of a request is known
+    def settle(self, provider, model, estimated, actual):
+        with self._condition:
+            for unit, bucket in self._buckets_for(provider, model):
+                if unit == "tpm":
+                    bucket.take(actual - estimated)
+            stats = self._stats.get(f"{provider}:{model}")
+            if stats is not None:
+                stats["tokens"] += actual - estimated
+            self._condition.notify_all()
+
+    # Runs call() once the limits allow it. Rate limit errors are retried with exponential
+    # backoff and full jitter, so concurrent callers don't retry in lockstep.
+    def run(self, provider, model, tokens, call):
+        for attempt in range(self.max_retries + 1):
+            observe_llm_wait(model, self.acquire(provider, model, tokens, current_priority()), retry=attempt > 0)
+            try:
+                return call()
+            except Exception as e:
+                if attempt == self.max_retries or not is_rate_limit_error(e):
+                    raise
+                with self._condition:
+                    # The provider is over its quota, everyone waiting for the model slows down
+                    for _, bucket in self._buckets_for(provider, model):
+                        bucket.drain()
+                    self._stats[f"{provider}:{model}"]["retries"] += 1
+                time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    def stats(self):
+        with self._condition:
+            return {key: dict(stats) for key, stats in self._stats.items()}
+
+
+llm_scheduler = LLMScheduler(LLM_RATE_LIMITS)
+
+
+_priority = contextvars.ContextVar("llm_priority", default=BULK)
+
+
+@contextmanager
+def llm_priority(priority):
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority():
+    return _priority.get()
+
+
+# LLM calls made by the decorated function go ahead of bulk pipeline work
+def interactive(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with llm_priority(INTERACTIVE):
+            return func(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+
+from cache import LRUCache, response_cache_bypassed, text_hash
+from metrics import observe_cache_lookups
+
+_MODEL_PATTERN = re.compile(r"""['"]model(?:_name)?['"][:,]\s*['"]([^'"]+)['"]""")
+
+
+# Model name for metrics labels, llm_string is the serialized model configuration
+def model_from_llm_string(llm_string):
+    match = _MODEL_PATTERN.search(llm_string)
+    return match.group(1) if match else "unknown"
+
+
+class MemoryResponseBackend:
+    def __init__(self, max_entries=10000):
+        self.entries = LRUCache(max_entries)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, value, expires_at):
+        self.entries.put(key, (value, expires_at))
+
+    def delete(self, key):
+        self.entries.delete(key)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class SQLiteResponseBackend:
+    def __init__(self, path, max_entries=100000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL,
+                created_at REAL NOT NULL
+            )
+        """)
+        self._connection.commit()
+
+    def get(self, key):
+        with self._lock:
+            return self._connection.execute(
+                "SELECT value, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+
+    def put(self, key, value, expires_at):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires_at, created_at) VALUES (?, ?, ?, ?)",
+                (key, value, expires_at, time.time())
+            )
+            count = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                self._connection.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY created_at LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+            self._connection.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._connection.commit()
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM responses")
+            self._connection.commit()
+
+
+class ResponseCache(BaseCache):
+    # Exact-match cache of LLM responses for every LangChain model in the process. The key
+    # covers the model configuration (llm_string) and the rendered prompt, which includes
+    # the format instructions of the output parser. Keys of recently stored or returned
+    # responses are remembered by response text, so a response that turns out to be unusable
+    # can be forgotten.
+    def __init__(self, backend, ttl_seconds=None, recent_entries=10000):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._recent_keys = LRUCache(recent_entries)
+
+    def _remember(self, key, generations):
+        for generation in generations:
+            self._recent_keys.put(text_hash(generation.text), key)
+
+    @staticmethod
+    def _key(prompt, llm_string):
+        return hashlib.sha256(f"{llm_string}\n{prompt}".encode("utf-8")).hexdigest()
+
+    def lookup(self, prompt, llm_string):
+        if response_cache_bypassed():
+            return None
+
+        key = self._key(prompt, llm_string)
+        entry = self.backend.get(key)
+        if entry is not None and entry[1] is not None and entry[1] < time.time():
+            self.backend.delete(key)
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            observe_cache_lookups("llm_response", model_from_llm_string(llm_string), 0, 1)
+            return None
+        self.hits += 1
+        observe_cache_lookups("llm_response", model_from_llm_string(llm_string), 1, 0)
+        generations = [loads(generation) for generation in json.loads(entry[0])]
+        self._remember(key, generations)
+        return generations
+
+    def update(self, prompt, llm_string, return_val):
+        expires_at = time.time() + self.ttl_seconds if self.ttl_seconds else None
+        value = json.dumps([dumps(generation) for generation in return_val])
+        key = self._key(prompt, llm_string)
+        self.backend.put(key, value, expires_at)
+        self._remember(key, return_val)
+
+    # Drops the cached response with this text, the next identical prompt asks the model again
+    def forget(self, text):
+        key = self._recent_keys.get(text_hash(text))
+        if key is not None:
+            self.backend.delete(key)
+            self._recent_keys.delete(text_hash(text))
+
+    def clear(self, **kwargs):
+        self.backend.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def create_response_cache():
+    kind = os.environ.get('LLM_CACHE', 'disk')
+    max_entries = int(os.environ.get('LLM_CACHE_MAX_ENTRIES', 100000))
+    ttl_seconds = float(os.environ.get('LLM_CACHE_TTL', 0)) or None
+
+    if kind == 'memory':
+        return ResponseCache(MemoryResponseBackend(max_entries), ttl_seconds)
+    if kind == 'disk':
+        path = os.environ.get('LLM_CACHE_PATH', os.path.join('cache', 'llm_responses.sqlite'))
+        return ResponseCache(SQLiteResponseBackend(path, max_entries), ttl_seconds)
+    return None
@@ -0,0 +1,154 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import Future
+
+import person_boxes
+from cache import LRUCache
+
+
+class ResultStore:
+    # Finished analyses as gzip compressed JSON files, one per key. detected_persons, by far
+    # the largest field, is kept next to it as compressed NumPy columns and only read when
+    # asked for. Recently read analyses are also kept in memory.
+    def __init__(self, folder, memory_entries=32):
+        self.folder = folder
+        self.memory = LRUCache(memory_entries)
+
+    def _path(self, key, suffix=".json.gz"):
+        return os.path.join(self.folder, key + suffix)
+
+    def _version(self, key):
+        try:
+            return os.stat(self._path(key)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _document(self, key):
+        version = self._version(key)
+        if version is None:
+            return None
+        cached = self.memory.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        try:
+            with gzip.open(self._path(key), "rt", encoding="utf-8") as file:
+                document = json.load(file)
+        except FileNotFoundError:
+            return None
+        self.memory.put(key, (version, document))
+        return document
+
+    # The stored result, or only the top-level fields listed in `fields`
+    def get(self, key, fields=None):
+        document = self._document(key)
+        if document is None:
+            return None
+
+        result = {name: value for name, value in document.items() if fields is None or name in fields}
+        if (fields is None or "detected_persons" in fields) and "detected_persons" not in document:
+            persons = self.persons_npz(key)
+            result["detected_persons"] = person_boxes.to_json(
+                person_boxes.from_npz(persons) if persons is not None else person_boxes.empty_columns())
+        return result
+
+    def persons_npz(self, key):
+        try:
+            with open(self._path(key, ".persons.npz"), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            document = self._document(key)
+            if document is None or "detected_persons" not in document:
+                return None
+            # Stored before detected_persons was split off
+            return person_boxes.to_npz(person_boxes.from_json(document["detected_persons"]))
+
+    # Changes whenever the result for the key is stored again
+    def etag(self, key, fields=None):
+        version = self._version(key)
+        if version is None:
+            return None
+        selection = ",".join(sorted(fields)) if fields is not None else "*"
+        return hashlib.sha256(f"{key}:{version}:{selection}".encode("utf-8")).hexdigest()[:32]
+
+    def put(self, key, result):
+        # Created with the first result, not on import
+        os.makedirs(self.folder, exist_ok=True)
+        document = dict(result)
+        if "detected_persons" in document:
+            persons_path = self._path(key, ".persons.npz")
+            with open(persons_path + ".part", "wb") as file:
+                file.write(person_boxes.to_npz(person_boxes.from_json(document.pop("detected_persons"))))
+            os.replace(persons_path + ".part", persons_path)
+
+        # The JSON file is written last, a result is only visible once it's complete
+        temp_path = self._path(key) + ".part"
+        with gzip.open(temp_path, "wt", encoding="utf-8") as file:
+            json.dump(document, file, default=str)
+        os.replace(temp_path, self._path(key))
+        self.memory.delete(key)
+
+    def fields(self, key):
+        document = self._document(key)
+        return None if document is None else set(document) | {"detected_persons"}
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share one execution of the function
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running = {}
+
+    def run(self, key, func):
+        with self._lock:
+            future = self._running.get(key)
+            owner = future is None
+            if owner:
+                future = self._running[key] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            future.set_result(func())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._running[key]
+        return future.result()
+
+
+result_store = ResultStore(
+    os.environ.get('RESULT_STORE_PATH', os.path.join('cache', 'results')),
+    memory_entries=int(os.environ.get('RESULT_STORE_MEMORY_ENTRIES', 32))
+)
+_single_flight = SingleFlight()
+
+
+# Returns the stored result for the key, or computes and stores it. Identical requests that
+# arrive while the result is being computed wait for that computation instead of repeating it.
+# Results for which is_complete(result) is false are returned without being stored.
+def get_or_compute(key, compute, refresh=False, is_complete=None):
+    if not refresh:
+        result = result_store.get(key)
+        if result is not None:
+            return result
+
+    def compute_and_store():
+        # A computation that finished after the lookup above
+        if not refresh:
+            result = result_store.get(key)
+            if result is not None:
+                return result
+
+        result = compute()
+        if is_complete is not None and not is_complete(result):
+            return result
+        result_store.put(key, result)
+        return result_store.get(key)
+
+    return _single_flight.run(key, compute_and_store)
@@ -1,11 +1,11 @@
-from langchain_core.output_parsers import PydanticOutputParser
-from langchain_core.prompts import PromptTemplate
-
-from llm_models import open_ai_llm_mini
+from llm_models import checked_chain, open_ai_llm_mini
 from transcript_analysis_models import Summary
 
 
 def write_summary(text):
+    from langchain_core.output_parsers import PydanticOutputParser
+    from langchain_core.prompts import PromptTemplate
+
     parser = PydanticOutputParser(pydantic_object=Summary)
 
     prompt_template = PromptTemplate(template="""
@@ -16,7 +16,7 @@ def write_summary(text):
         input_variables=["text"],
         partial_variables={"format_instructions": parser.get_format_instructions()})
 
-    chain = prompt_template | open_ai_llm_mini | parser
+    chain = checked_chain(prompt_template, open_ai_llm_mini(), parser)
     response = chain.invoke({"text": text})
 
     return response
@@ -1,11 +1,17 @@
-from typing import List, Optional
+import json
+import os
+from collections import Counter
+from functools import lru_cache
+from typing import Callable, List, Optional, Union
 from enum import Enum
 
-from langchain_core.output_parsers import PydanticOutputParser
-from langchain_core.prompts import PromptTemplate
 from pydantic import BaseModel, Field
 
-from llm_models import open_ai_llm_mini, open_ai_llm
+from llm_models import checked_chain, open_ai_llm_mini, open_ai_llm
+
+# Transcripts longer than this many segments are analyzed in overlapping windows, 0 never splits them
+TRANSCRIPTION_CHUNK_SIZE = int(os.environ.get('TRANSCRIPTION_CHUNK_SIZE', 120))
+TRANSCRIPTION_CHUNK_OVERLAP = int(os.environ.get('TRANSCRIPTION_CHUNK_OVERLAP', 10))
 
 
 class SentimentType(str, Enum):
@@ -76,7 +82,6 @@ class TargetGroupPercentage(BaseModel):
     AGE_GROUP_65_PLUS: float
 
 
-
 class QualityMetrics(BaseModel):
     clarity_coherence: QualityMetric
     gunning_fog_index: int = Field(..., description="Calculate gunning fog index for while transcript")
@@ -100,6 +105,20 @@ class QualityMetrics(BaseModel):
     facts_to_verify: List[FactDetail] = Field(..., description="All information presented as facts that user ought to carefully verify with own research")
 
 
+QUALITY_METRIC_FIELDS = ["clarity_coherence", "grammar_syntax", "relevance_to_subject", "vocabulary_richness",
+                         "filler_words_usage", "structure_organization", "persuasiveness"]
+
+
+class TranscriptionSummary(BaseModel):
+    clarity_coherence: str = Field(..., description="Justification of the clarity and coherence score")
+    grammar_syntax: str = Field(..., description="Justification of the grammar and syntax score")
+    relevance_to_subject: str = Field(..., description="Justification of the relevance to main subject score")
+    vocabulary_richness: str = Field(..., description="Justification of the vocabulary richness score")
+    filler_words_usage: str = Field(..., description="Justification of the filler words usage score")
+    structure_organization: str = Field(..., description="Justification of the structure and organization score")
+    persuasiveness: str = Field(..., description="Justification of the persuasiveness score")
+    structure_conserved_score: QualityMetric = Field(..., description="ocenić strukturę wypowiedzi - czy był zachowany wstęp, rozwinięcie i zakończenie")
+    key_topics: List[str]
 
 
 class SegmentAnalysis(BaseModel):
@@ -132,11 +151,16 @@ class ComparativeAnalysis(BaseModel):
             }
         }
 
+class WindowComparativeAnalysis(BaseModel):
+    comparisons: List[ComparativeAnalysis] = Field(..., description="Comparison of every pair of consecutive segments, in order")
+
 class EventAnalysis(BaseModel):
     index: int
     from_segment: int
     to_segment: int
-    event_analysis: ComparativeAnalysis
+    # Only one of them is set, error when the pair couldn't be analyzed
+    event_analysis: Optional[ComparativeAnalysis] = None
+    error: Optional[str] = None
 
 class SubtitlesAnalysis(BaseModel):
     subtitles_similarity: int = Field(..., description="Score in %")
@@ -150,6 +174,9 @@ class SubtitlesAnalysis(BaseModel):
             }
         }
 
+class SubtitlesChanges(BaseModel):
+    changes: List[str] = Field(..., description="List of changes between transcription and OCR subtitles of all pairs")
+
 class Questions(BaseModel):
     questions: List[str] = Field(..., description="List of questions for text")
 
@@ -171,8 +198,15 @@ class Summary(BaseModel):
         }
 
 
-# Function to analyze a single segment independently
-def analyze_segment(segment_transcription: str) -> SegmentAnalysis:
+class SegmentAnalysisBatch(BaseModel):
+    analyses: List[SegmentAnalysis] = Field(..., description="Analysis of every segment, in the same order as the indexed segments")
+
+
+@lru_cache(maxsize=None)
+def segment_analysis_chain():
+    from langchain_core.output_parsers import PydanticOutputParser
+    from langchain_core.prompts import PromptTemplate
+
     parser = PydanticOutputParser(pydantic_object=SegmentAnalysis)
 
     prompt_template = PromptTemplate( template = """
@@ -195,15 +229,104 @@ def analyze_segment(segment_transcription: str) -> SegmentAnalysis:
       partial_variables={"format_instructions": parser.get_format_instructions()}
     )
 
-    chain = prompt_template | open_ai_llm_mini | parser
-    response = chain.invoke({"segment_transcription": segment_transcription})
+    return checked_chain(prompt_template, open_ai_llm_mini(), parser)
+
+
+# An answer for a different number of segments can't be matched to them, it's rejected
+# like an unparsable one
+def _check_analyses_count(inputs, response):
+    from langchain_core.exceptions import OutputParserException
+
+    if len(response.analyses) != inputs["count"]:
+        raise OutputParserException(f"Expected {inputs['count']} segment analyses, got {len(response.analyses)}")
+
+
+@lru_cache(maxsize=None)
+def packed_segment_analysis_chain():
+    from langchain_core.output_parsers import PydanticOutputParser
+    from langchain_core.prompts import PromptTemplate
+
+    parser = PydanticOutputParser(pydantic_object=SegmentAnalysisBatch)
+
+    prompt_template = PromptTemplate( template = """
+        You are an expert speech analyst. Analyze each of the following indexed transcribed speech segments independently and provide the analysis.
+        Return exactly one analysis per segment, in the order of the indexes.
+        
+        1. Clarity and Coherence (score out of 10):
+        2. Sentiment Analysis (Positive/Negative/Neutral):
+        3. Key Topics Discussed (List of topics):
+        4. Always return data in Polish language
+       Format:
+        {format_instructions}
+            
+        Segments:
+        \"\"\"
+        {segments}
+        \"\"\"
+    """,
+
+      input_variables=["segments"],
+      partial_variables={"format_instructions": parser.get_format_instructions()}
+    )
+
+    return checked_chain(prompt_template, open_ai_llm_mini(), parser, check=_check_analyses_count)
+
+
+# Function to analyze a single segment independently
+def analyze_segment(segment_transcription: str) -> SegmentAnalysis:
+    response = segment_analysis_chain().invoke({"segment_transcription": segment_transcription})
 
     return response
 
 
-# Function to perform comparative analysis between two consecutive segments
-def analyze_segments_comparatively(previous_segment: dict[str, any],
-                                   current_segment: dict[str, any]) -> ComparativeAnalysis:
+# Analyze many segments independently with at most max_concurrency requests in flight.
+# With segments_per_prompt > 1 several segments are sent in one prompt. A failed request
+# doesn't fail the batch, its segments get the exception instead of a SegmentAnalysis.
+# on_result(index, result) is called for every segment as soon as its analysis arrives.
+def analyze_segments(segments: List[dict[str, any]],
+                     max_concurrency: int = 8,
+                     segments_per_prompt: int = 1,
+                     on_result: Optional[Callable[[int, Union[SegmentAnalysis, Exception]], None]] = None
+                     ) -> List[Union[SegmentAnalysis, Exception]]:
+    config = {"max_concurrency": max_concurrency}
+    results = [None] * len(segments)
+
+    def add(index, result):
+        results[index] = result
+        if on_result is not None:
+            on_result(index, result)
+
+    if segments_per_prompt <= 1:
+        for index, result in segment_analysis_chain().batch_as_completed(
+                [{"segment_transcription": segment["text"]} for segment in segments],
+                config=config,
+                return_exceptions=True):
+            add(index, result)
+        return results
+
+    starts = range(0, len(segments), segments_per_prompt)
+    groups = [segments[start:start + segments_per_prompt] for start in starts]
+    for group_index, response in packed_segment_analysis_chain().batch_as_completed(
+            [{"segments": "\n".join(f"{index}: {segment['text']}" for index, segment in enumerate(group)),
+              "count": len(group)}
+             for group in groups],
+            config=config,
+            return_exceptions=True):
+        group = groups[group_index]
+        if isinstance(response, Exception):
+            group_results = [response] * len(group)
+        else:
+            group_results = response.analyses
+        for offset, result in enumerate(group_results):
+            add(starts[group_index] + offset, result)
+
+    return results
+
+
+@lru_cache(maxsize=None)
+def comparative_analysis_chain():
+    from langchain_core.output_parsers import PydanticOutputParser
+    from langchain_core.prompts import PromptTemplate
 
     parser = PydanticOutputParser(pydantic_object=ComparativeAnalysis)
 
@@ -236,8 +359,55 @@ def analyze_segments_comparatively(previous_segment: dict[str, any],
       partial_variables={"format_instructions": parser.get_format_instructions()},
 
     )
-    chain = prompt_template | open_ai_llm_mini | parser
-    response = chain.invoke({
+    return checked_chain(prompt_template, open_ai_llm_mini(), parser)
+
+
+def _check_comparisons_count(inputs, response):
+    from langchain_core.exceptions import OutputParserException
+
+    if len(response.comparisons) != inputs["pairs"]:
+        raise OutputParserException(f"Expected {inputs['pairs']} comparisons, got {len(response.comparisons)}")
+
+
+@lru_cache(maxsize=None)
+def windowed_comparative_analysis_chain():
+    from langchain_core.output_parsers import PydanticOutputParser
+    from langchain_core.prompts import PromptTemplate
+
+    parser = PydanticOutputParser(pydantic_object=WindowComparativeAnalysis)
+
+    prompt_template = PromptTemplate( template ="""
+        You are an expert speech analyst. Compare every pair of consecutive segments in the following run of indexed transcribed speech segments and provide the analysis.
+        Return exactly one comparison per pair of consecutive segments, in order: first segment {first_index} with {second_index}, then {second_index} with the next one and so on.
+        Always return data in return data in Polish language.
+        
+        Segments:
+        \"\"\"
+        {segments}
+        \"\"\"
+
+       Format:
+        {format_instructions}
+            
+        For every pair compare and analyze:
+        1. Changes in Sentiment:
+        2. Changes in Topics Discussed:
+        3. Any Significant Events or Shifts:
+
+        Provide details for any detected changes or events.
+    """,
+
+      input_variables=["segments", "first_index", "second_index"],
+      partial_variables={"format_instructions": parser.get_format_instructions()},
+
+    )
+    return checked_chain(prompt_template, open_ai_llm_mini(), parser, check=_check_comparisons_count)
+
+
+# Function to perform comparative analysis between two consecutive segments
+def analyze_segments_comparatively(previous_segment: dict[str, any],
+                                   current_segment: dict[str, any]) -> ComparativeAnalysis:
+    response = comparative_analysis_chain().invoke({
         "previous_text": previous_segment["text"],
         "current_text": current_segment["text"]
     })
@@ -245,7 +415,73 @@ def analyze_segments_comparatively(previous_segment: dict[str, any],
     return response
 
 
-def analyze_transcription(segments: List[dict[str, any]]):
+# Comparative analysis of every pair of consecutive segments. Runs of window_size segments
+# are sent in one prompt and return all window_size - 1 boundaries at once, consecutive
+# windows share one segment so no boundary is skipped. Windows run concurrently.
+# on_result(event) is called for every EventAnalysis as soon as it arrives. Pairs that
+# can't be analyzed get an EventAnalysis with the error instead of failing the whole call.
+def analyze_events(segments: List[dict[str, any]],
+                   window_size: int = 8,
+                   max_concurrency: int = 8,
+                   on_result: Optional[Callable[[EventAnalysis], None]] = None) -> List[EventAnalysis]:
+    config = {"max_concurrency": max_concurrency}
+    window_size = max(window_size, 2)
+    events = {}
+
+    def add(index, event_analysis):
+        if isinstance(event_analysis, Exception):
+            events[index] = EventAnalysis(index=index, from_segment=index - 1, to_segment=index,
+                                          error=str(event_analysis))
+        else:
+            events[index] = EventAnalysis(
+                index=index,
+                from_segment=index - 1,
+                to_segment=index,
+                event_analysis=event_analysis
+            )
+        if on_result is not None:
+            on_result(events[index])
+
+    if window_size == 2:
+        for position, comparison in comparative_analysis_chain().batch_as_completed(
+                [{"previous_text": segments[i - 1]["text"], "current_text": segments[i]["text"]}
+                 for i in range(1, len(segments))],
+                config=config,
+                return_exceptions=True):
+            add(position + 1, comparison)
+    else:
+        starts = range(0, max(len(segments) - 1, 0), window_size - 1)
+        windows = [(start, segments[start:start + window_size]) for start in starts]
+        for window_index, response in windowed_comparative_analysis_chain().batch_as_completed(
+                [{
+                    "segments": "\n".join(f"{start + index}: {segment['text']}" for index, segment in enumerate(window)),
+                    "first_index": start,
+                    "second_index": start + 1,
+                    "pairs": len(window) - 1
+                } for start, window in windows],
+                config=config,
+                return_exceptions=True):
+            start, window = windows[window_index]
+            if isinstance(response, Exception):
+                # Fall back to one prompt per pair when the window can't be used
+                response_comparisons = comparative_analysis_chain().batch(
+                    [{"previous_text": window[i - 1]["text"], "current_text": window[i]["text"]}
+                     for i in range(1, len(window))],
+                    config=config,
+                    return_exceptions=True
+                )
+            else:
+                response_comparisons = response.comparisons
+            for offset, comparison in enumerate(response_comparisons, start=1):
+                add(start + offset, comparison)
+
+    return [events[index] for index in sorted(events)]
+
+
+@lru_cache(maxsize=None)
+def transcription_analysis_chain():
+    from langchain_core.output_parsers import PydanticOutputParser
+    from langchain_core.prompts import PromptTemplate
 
     parser = PydanticOutputParser(pydantic_object=QualityMetrics)
 
@@ -324,15 +560,193 @@ def analyze_transcription(segments: List[dict[str, any]]):
             \"\"\"
         """
     )
-    chain = prompt_template | open_ai_llm | parser
+    return checked_chain(prompt_template, open_ai_llm(), parser)
+
+
+@lru_cache(maxsize=None)
+def transcription_summary_chain():
+    from langchain_core.output_parsers import PydanticOutputParser
+    from langchain_core.prompts import PromptTemplate
+
+    parser = PydanticOutputParser(pydantic_object=TranscriptionSummary)
+
+    prompt_template = PromptTemplate(
+        input_variables=["partial_analyses", "beginning", "ending"],
+        partial_variables={"format_instructions": parser.get_format_instructions()},
+        template="""
+            You are an expert speech analyst. A long transcribed speech was analyzed in consecutive parts.
+            Combine the partial analyses into an analysis of the whole speech. All justifications should be in Polish.
+            
+            1. For every metric write one justification for the whole speech based on the partial justifications.
+            2. Rate if the structure of the speech was conserved - was there an introduction, development and conclusion (score out of 10), based on its beginning and ending.
+            3. List the key topics of the whole speech, merging duplicates.
+            
+            Format:
+            {format_instructions}
+            
+            Partial analyses:
+            \"\"\"
+            {partial_analyses}
+            \"\"\"
+            
+            Beginning of the speech:
+            \"\"\"
+            {beginning}
+            \"\"\"
+            
+            Ending of the speech:
+            \"\"\"
+            {ending}
+            \"\"\"
+        """
+    )
+    return checked_chain(prompt_template, open_ai_llm_mini(), parser)
+
+
+def indexed_transcription(segments: List[dict[str, any]]):
+    return [f"{index}: {d['text']}" for index, d in enumerate(segments)]
+
 
-    transcription = [f"{index}: {d['text']}" for index, d in enumerate(segments)]
+# Analyzes the whole transcript in one prompt, or in overlapping windows of chunk_size segments
+# when it is longer than that (see analyze_transcription_in_chunks)
+def analyze_transcription(segments: List[dict[str, any]],
+                          chunk_size: int = TRANSCRIPTION_CHUNK_SIZE,
+                          overlap: int = TRANSCRIPTION_CHUNK_OVERLAP,
+                          max_concurrency: int = 4) -> QualityMetrics:
+    if chunk_size and len(segments) > chunk_size:
+        return analyze_transcription_in_chunks(segments, chunk_size, overlap, max_concurrency)
 
-    response = chain.invoke({"transcription": transcription})
+    response = transcription_analysis_chain().invoke({"transcription": indexed_transcription(segments)})
 
     return response
 
 
+# Every segment is owned by one window: overlapping segments are split between the two windows
+# at the middle of the overlap, so each window owns the segments it saw with most context
+def window_ownership(starts: List[int], overlap: int, total: int):
+    owned = []
+    for k, start in enumerate(starts):
+        owned_from = start + overlap // 2 if k > 0 else 0
+        owned_to = starts[k + 1] + overlap // 2 if k + 1 < len(starts) else total
+        owned.append((owned_from, owned_to))
+    return owned
+
+
+def analyze_transcription_in_chunks(segments: List[dict[str, any]],
+                                    chunk_size: int,
+                                    overlap: int,
+                                    max_concurrency: int = 4) -> QualityMetrics:
+    overlap = min(overlap, chunk_size // 2)
+    starts = list(range(0, max(len(segments) - overlap, 1), chunk_size - overlap))
+    windows = [segments[start:start + chunk_size] for start in starts]
+
+    # Map: every window is analyzed as a transcript on its own, with local segment indexes
+    partials = transcription_analysis_chain().batch(
+        [{"transcription": indexed_transcription(window)} for window in windows],
+        config={"max_concurrency": max_concurrency}
+    )
+
+    merged = merge_quality_metrics(partials, starts, window_ownership(starts, overlap, len(segments)))
+
+    # Reduce: only the fields that need the whole transcript go to the LLM again
+    summary = transcription_summary_chain().invoke({
+        "partial_analyses": json.dumps([
+            {
+                "segments": f"{start}-{start + len(window) - 1}",
+                **{name: getattr(partial, name).dict() for name in QUALITY_METRIC_FIELDS},
+                "key_topics": partial.key_topics,
+            }
+            for start, window, partial in zip(starts, windows, partials)
+        ], ensure_ascii=False),
+        "beginning": indexed_transcription(segments[:10]),
+        "ending": [f"{index}: {d['text']}" for index, d in enumerate(segments[-10:], start=max(len(segments) - 10, 0))],
+    })
+
+    for name in QUALITY_METRIC_FIELDS:
+        getattr(merged, name).justification = getattr(summary, name)
+    merged.structure_conserved_score = summary.structure_conserved_score
+    merged.key_topics = summary.key_topics or merged.key_topics
+
+    return merged
+
+
+def _weighted_mean(values, weights):
+    return sum(value * weight for value, weight in zip(values, weights)) / sum(weights)
+
+
+def _unique(values, key=lambda value: value):
+    seen = set()
+    result = []
+    for value in values:
+        if key(value) not in seen:
+            seen.add(key(value))
+            result.append(value)
+    return result
+
+
+# Deterministic merge of window analyses: scores are averaged weighted by the number of segments
+# each window owns, per-segment data is taken from the owning window and shifted to global indexes
+def merge_quality_metrics(partials: List[QualityMetrics], starts: List[int], owned) -> QualityMetrics:
+    weights = [max(owned_to - owned_from, 1) for owned_from, owned_to in owned]
+
+    def merged_metric(name):
+        metrics = [getattr(partial, name) for partial in partials]
+        return QualityMetric(
+            score=round(_weighted_mean([metric.score for metric in metrics], weights)),
+            justification=" ".join(metric.justification for metric in metrics)
+        )
+
+    sentiments = list(SentimentType)
+    overall = _weighted_mean([sentiments.index(SentimentType(partial.sentiment.overall)) for partial in partials], weights)
+    emotions = Counter(emotion for partial in partials for emotion in partial.sentiment.emotions_detected)
+
+    issues_detected = []
+    off_topic_segments = []
+    categorized_segments = []
+    for partial, start, (owned_from, owned_to) in zip(partials, starts, owned):
+        for index in range(owned_from, owned_to):
+            local = index - start
+            issues_detected.append(partial.issues_detected[local] if local < len(partial.issues_detected) else [])
+
+        for segment in partial.llm_off_topic_segments:
+            if owned_from <= segment.segment_index + start < owned_to:
+                off_topic_segments.append(segment.copy(update={"segment_index": segment.segment_index + start}))
+
+        for category in partial.categorized_segments:
+            from_segment = max(category.from_segment + start, owned_from)
+            to_segment = min(category.to_segments + start, owned_to - 1)
+            if from_segment > to_segment:
+                continue
+            previous = categorized_segments[-1] if categorized_segments else None
+            # A category running across the window boundary becomes one range
+            if previous and previous.category == category.category and previous.to_segments + 1 >= from_segment:
+                previous.to_segments = max(previous.to_segments, to_segment)
+            else:
+                categorized_segments.append(SegmentsCategorization(
+                    category=category.category, from_segment=from_segment, to_segments=to_segment))
+
+    age_groups = {
+        name: _weighted_mean([getattr(partial.age_target_groups, name) for partial in partials], weights)
+        for name in TargetGroupPercentage.model_fields
+    }
+
+    return QualityMetrics(
+        **{name: merged_metric(name) for name in QUALITY_METRIC_FIELDS + ["structure_conserved_score"]},
+        gunning_fog_index=round(_weighted_mean([partial.gunning_fog_index for partial in partials], weights)),
+        age_target_groups=TargetGroupPercentage(**age_groups),
+        sentiment=Sentiment(
+            overall=sentiments[round(overall)],
+            emotions_detected=[emotion for emotion, _ in emotions.most_common()]
+        ),
+        llm_off_topic_segments=off_topic_segments,
+        key_topics=_unique([topic for partial in partials for topic in partial.key_topics], key=str.lower),
+        categorized_segments=categorized_segments,
+        issues_detected=issues_detected,
+        facts_to_verify=_unique([fact for partial in partials for fact in partial.facts_to_verify],
+                                key=lambda fact: " ".join(fact.fact.lower().split()))
+    )
+
+
 class AnalysisResult(BaseModel):
     main_subject: str
     off_topic_segments: List[OffTopicSegment]
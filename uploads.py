@@ -0,0 +1,31 @@
+import hashlib
+import os
+import tempfile
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+# Streams an uploaded file to the upload folder while hashing it. The file is stored
+# under its content hash, so identical uploads end up in the same file.
+def save_upload(file, upload_folder, extension=".mp4"):
+    sha256 = hashlib.sha256()
+    os.makedirs(upload_folder, exist_ok=True)
+    descriptor, temp_path = tempfile.mkstemp(dir=upload_folder, suffix=".part")
+    try:
+        with os.fdopen(descriptor, "wb") as temp_file:
+            while True:
+                chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+                temp_file.write(chunk)
+
+        content_hash = sha256.hexdigest()
+        path = os.path.join(upload_folder, content_hash + extension)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    return content_hash, path
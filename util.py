@@ -1,15 +1,35 @@
-from langchain_core.prompts import PromptTemplate
-from nltk import sent_tokenize
+import os
+from functools import lru_cache
 
 from llm_models import open_ai_llm
 
+NLTK_DATA = os.environ.get('NLTK_DATA', os.path.abspath('nltk_data'))
+
+
+# Downloads punkt only when it isn't found in NLTK_DATA or the default nltk data directories
+@lru_cache(maxsize=None)
+def ensure_punkt():
+    import nltk
+
+    if NLTK_DATA not in nltk.data.path:
+        nltk.data.path.insert(0, NLTK_DATA)
+    try:
+        nltk.data.find('tokenizers/punkt')
+    except LookupError:
+        nltk.download('punkt', download_dir=NLTK_DATA)
+
 
 def segment_transcript(transcription):
+    from nltk import sent_tokenize
+
+    ensure_punkt()
     sentences = sent_tokenize(transcription)
     return sentences
 
 
 def extract_main_subject(transcription):
+    from langchain_core.prompts import PromptTemplate
+
     prompt_template = PromptTemplate(
         input_variables=["transcription"],
         template="""
@@ -22,7 +42,7 @@ def extract_main_subject(transcription):
             Provide the main subject in one or two sentences.
         """
     )
-    chain = prompt_template | open_ai_llm
+    chain = prompt_template | open_ai_llm()
 
     main_subject = chain.invoke({"transcription": transcription})
     return main_subject.content
@@ -1,12 +1,38 @@
 import io
+import os
+import subprocess
 
-from google.cloud import videointelligence
+import fake_backends
+from object_store import object_store
+from person_boxes import columns_from_annotations, reduce_columns
 
+# Optional smaller copy of the video that is sent instead of the upload
+VIDEO_PROXY_HEIGHT = int(os.environ.get('VIDEO_PROXY_HEIGHT', 0))
+VIDEO_PROXY_FPS = float(os.environ.get('VIDEO_PROXY_FPS', 0))
 
 
-def analyze_video(path):
-    # Initialize the Video Intelligence client
-    video_client = videointelligence.VideoIntelligenceServiceClient()
+# Downscales the video to `height` pixels and resamples it to `fps` frames per second. Audio
+# is dropped. Bounding boxes are normalized and timestamps are kept, so annotations of the
+# proxy apply to the original video.
+def create_proxy(path, height=VIDEO_PROXY_HEIGHT, fps=VIDEO_PROXY_FPS):
+    proxy_path = os.path.splitext(path)[0] + f".proxy-{height}p-{fps:g}fps.mp4"
+    command = ["ffmpeg", "-nostdin", "-y", "-i", path, "-an"]
+    if height:
+        command += ["-vf", f"scale=-2:{height}"]
+    if fps:
+        command += ["-r", str(fps)]
+    command += ["-c:v", "libx264", "-preset", "veryfast", "-crf", "28", proxy_path]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return proxy_path
+
+
+# Features and settings of the annotation request, the fake client doesn't need them and
+# works without the Google SDK installed
+def _video_request():
+    if fake_backends.enabled("video"):
+        return {}
+
+    from google.cloud import videointelligence
 
     # Define the features to detect text and persons in the video
     features = [
@@ -26,18 +52,39 @@ def analyze_video(path):
         person_detection_config=person_detection_config
     )
 
-    # Read the video file
-    with io.open(path, "rb") as file:
-        input_content = file.read()
+    return {
+        "features": features,
+        "video_context": video_context,
+    }
+
+
+def analyze_video(path):
+    # Initialize the Video Intelligence client
+    if fake_backends.enabled("video"):
+        video_client = fake_backends.FakeVideoIntelligenceClient()
+    else:
+        from google.cloud import videointelligence
+
+        video_client = videointelligence.VideoIntelligenceServiceClient()
+
+    request = _video_request()
+
+    proxy_path = create_proxy(path) if VIDEO_PROXY_HEIGHT or VIDEO_PROXY_FPS else None
+    try:
+        store = object_store()
+        if store is not None:
+            # Stream the video to the object store and let the service read it from there
+            request["input_uri"] = store.upload(proxy_path or path, os.path.basename(proxy_path or path))
+        else:
+            # Read the video file
+            with io.open(proxy_path or path, "rb") as file:
+                request["input_content"] = file.read()
+    finally:
+        if proxy_path is not None:
+            os.remove(proxy_path)
 
     # Create the video annotation request with both features
-    operation = video_client.annotate_video(
-        request={
-            "features": features,
-            "input_content": input_content,
-            "video_context": video_context,
-        }
-    )
+    operation = video_client.annotate_video(request=request)
 
     print("Processing video for text and person detection.")
     result = operation.result(timeout=600)
@@ -45,6 +92,7 @@ def analyze_video(path):
     # Process the text detection annotations
     annotation_result = result.annotation_results[0]
     subtitles = []
+    seen_texts = set()
 
     for text_annotation in annotation_result.text_annotations:
         vertices = text_annotation.segments[0].frames[0].rotated_bounding_box.vertices
@@ -57,32 +105,25 @@ def analyze_video(path):
             start_time = text_annotation.segments[0].segment.start_time_offset
             end_time = text_annotation.segments[-1].segment.end_time_offset
 
-            if text and not any(s["text"] == text for s in subtitles):
+            if text and text not in seen_texts:
+                seen_texts.add(text)
                 subtitles.append({
                     "text": text,
                     "start_time": start_time.seconds + start_time.microseconds * 1e-6,
                     "end_time": end_time.seconds + end_time.microseconds * 1e-6,
                     "confidence": text_annotation.segments[0].confidence,
-                    "text_box": "({x1}, {y1}) -> ({x2}, {y2})".format(x1=vertices[0].x, y1=vertices[0].y, x2=vertices[3].x, y2=vertices[3].y)
+                    "text_box": "({x1}, {y1}) -> ({x2}, {y2})".format(x1=vertices[0].x, y1=vertices[0].y, x2=vertices[3].x, y2=vertices[3].y),
+                    "x1": vertices[0].x,
+                    "y1": vertices[0].y,
+                    "x2": vertices[3].x,
+                    "y2": vertices[3].y,
                 })
 
-    # Sort the detected subtitles
-    sorted_subtitles = sorted(sorted(subtitles, key=lambda d: d["text_box"].split(",")[1]), key=lambda d: d['start_time'])
-
-    # Process the person detection annotations
-    bounding_boxes = []
-    for person_annotation in annotation_result.person_detection_annotations:
-        for track in person_annotation.tracks:
-            for timestamped_object in track.timestamped_objects:
-                bounding_box = {
-                    "time_offset": timestamped_object.time_offset.seconds + timestamped_object.time_offset.microseconds * 1e-6,
-                    "left": timestamped_object.normalized_bounding_box.left,
-                    "top": timestamped_object.normalized_bounding_box.top,
-                    "right": timestamped_object.normalized_bounding_box.right,
-                    "bottom": timestamped_object.normalized_bounding_box.bottom,
-                }
-                bounding_boxes.append(bounding_box)
+    # Sort the detected subtitles by time, subtitles shown at the same time from top to bottom
+    sorted_subtitles = sorted(subtitles, key=lambda d: (d["start_time"], d["y1"]))
 
+    # Process the person detection annotations into columns of box coordinates
+    person_boxes = reduce_columns(columns_from_annotations(annotation_result.person_detection_annotations))
 
     # Return the results of both text detection and person detection
-    return sorted_subtitles, bounding_boxes
+    return sorted_subtitles, person_boxes
@@ -0,0 +1,72 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import fake_backends
+
+DEFAULT_MODEL = os.environ.get('WHISPER_MODEL', 'base')
+
+
+class WhisperModelPool:
+    # Loads every Whisper model size once per process and shares it between requests.
+    # Each loaded model is used by at most `concurrency` transcriptions at the same time.
+    # A lane other than "default" gets its own copy of the model, so live streams aren't
+    # queued behind the transcription of long uploads.
+    def __init__(self, model_names, concurrency=1):
+        self.model_names = list(model_names)
+        self.concurrency = concurrency
+        self._lock = threading.Lock()
+        self._models = {}
+        self._semaphores = {}
+        self._stats = {}
+
+    def get(self, name=DEFAULT_MODEL, lane="default"):
+        key = name if lane == "default" else f"{name}@{lane}"
+        model = self._models.get(key)
+        if model is not None:
+            return model
+
+        with self._lock:
+            if key not in self._models:
+                if fake_backends.enabled("whisper"):
+                    model = fake_backends.FakeWhisperModel(name)
+                    self._stats[key] = {"load_seconds": 0.0, "memory_bytes": 0, "device": "fake"}
+                else:
+                    # Importing whisper loads torch, so it only happens when a model is needed
+                    import whisper
+
+                    started = time.perf_counter()
+                    model = whisper.load_model(name)
+                    self._stats[key] = {
+                        "load_seconds": time.perf_counter() - started,
+                        "memory_bytes": sum(tensor.numel() * tensor.element_size()
+                                            for tensor in list(model.parameters()) + list(model.buffers())),
+                        "device": str(model.device),
+                    }
+                self._semaphores[key] = threading.BoundedSemaphore(self.concurrency)
+                self._models[key] = model
+            return self._models[key]
+
+    @contextmanager
+    def acquire(self, name=DEFAULT_MODEL, lane="default"):
+        model = self.get(name, lane)
+        with self._semaphores[name if lane == "default" else f"{name}@{lane}"]:
+            yield model
+
+    def preload(self):
+        for name in self.model_names:
+            self.get(name)
+
+    def stats(self):
+        return {
+            "configured": self.model_names,
+            "concurrency": self.concurrency,
+            "loaded": {name: dict(stats) for name, stats in self._stats.items()},
+        }
+
+
+whisper_models = WhisperModelPool(
+    model_names=os.environ.get('WHISPER_MODELS', DEFAULT_MODEL).split(','),
+    concurrency=int(os.environ.get('WHISPER_MODEL_CONCURRENCY', 1))
+)